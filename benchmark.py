@@ -0,0 +1,199 @@
+import argparse
+import collections
+import imp
+import sys
+import threading
+import time
+import uuid
+import redis
+import redis.client
+
+# Simulate complete call flows against the redialer webhooks through the Flask
+# test client, with a stub Twilio client and a local Redis (or fakeredis), and
+# report per-route latency, Redis commands per call and throughput.
+
+OUR_NUMBER = '+12025550100'
+
+class RedisCounter(object):
+	'''
+	Count Redis round trips and commands made by every client in the process
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.round_trips = 0
+		self.commands = 0
+
+	def add(self, round_trips, commands):
+		with self.lock:
+			self.round_trips += round_trips
+			self.commands += commands
+
+	def install(self):
+		counter = self
+		execute_command = redis.client.Redis.execute_command
+		execute_pipeline = redis.client.Pipeline.execute
+
+		def counted_execute_command(self, *args, **kwargs):
+			counter.add(1, 1)
+			return execute_command(self, *args, **kwargs)
+
+		def counted_execute_pipeline(self, *args, **kwargs):
+			counter.add(1, len(self.command_stack))
+			return execute_pipeline(self, *args, **kwargs)
+
+		redis.client.Redis.execute_command = counted_execute_command
+		redis.client.Pipeline.execute = counted_execute_pipeline
+
+class Recorder(object):
+	'''
+	Collect latencies (in seconds) by route
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.latencies = collections.defaultdict(list)
+
+	def add(self, route, elapsed):
+		with self.lock:
+			self.latencies[route].append(elapsed)
+
+def percentile(values, fraction):
+	ordered = sorted(values)
+	return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def load_config(redis_db):
+	'''
+	Load config.py, or config.example.py if there isn't one, forcing the stub
+	Twilio client and a separate Redis database
+	'''
+	try:
+		import config
+	except ImportError:
+		config = imp.load_source('config', 'config.example.py')
+	config.TWILIO_STUB = True
+	config.REDIS_CLIENT_KWARGS = dict(config.REDIS_CLIENT_KWARGS, db=redis_db)
+	return config
+
+def simulate_call(client, recorder, redialer, worker, caller_number, zip_code, busy_cycles):
+	'''
+	Run one call through greeting, ZIP entry, member selection, a number of
+	busy redials, connection and hangup
+	'''
+	inbound_sid = 'CA' + uuid.uuid4().hex
+	form = {'CallSid': inbound_sid, 'From': caller_number, 'To': OUR_NUMBER}
+
+	def post(route, path, **fields):
+		start = time.time()
+		response = client.post(path, data=dict(form, **fields))
+		recorder.add(route, time.time() - start)
+		if response.status_code >= 400:
+			raise RuntimeError('{0} returned {1}'.format(path, response.status_code))
+		return response
+
+	def timed(route, func, *args):
+		start = time.time()
+		result = func(*args)
+		recorder.add(route, time.time() - start)
+		return result
+
+	post('greet_caller', '/')
+	post('set_zip_code', '/set_zip_code')
+	post('set_zip_code', '/set_zip_code', Digits=zip_code)
+	post('select_member', '/select_member')
+	post('select_member', '/select_member', Digits='1')
+	post('wait_for_outbound', '/inbound/wait')
+
+	for i in range(busy_cycles + 1):
+		outbound_sid = redialer.CallState.get_last_attempt(inbound_sid)
+		if outbound_sid is None:
+			# the first attempt was queued rather than placed; let the worker place it
+			timed('dispatch', worker.dispatch_scheduled_calls)
+			continue
+		to = redialer.CallState.get_context(inbound_sid=inbound_sid)['data'].get('to')
+		outbound = {'CallSid': outbound_sid, 'From': OUR_NUMBER, 'To': to}
+		if i < busy_cycles:
+			post('ping_outbound', '/outbound/ping', CallStatus='busy', **outbound)
+			timed('dispatch', worker.dispatch_scheduled_calls)
+		else:
+			post('ping_outbound', '/outbound/ping', CallStatus='ringing', **outbound)
+			post('connect_outbound', '/outbound/connect', **outbound)
+			post('ping_outbound', '/outbound/ping', CallStatus='in-progress', **outbound)
+			post('ping_outbound', '/outbound/ping', CallStatus='completed', **outbound)
+
+	post('ping_inbound', '/inbound/ping', CallStatus='completed', Duration='120')
+
+def drain_jobs(recorder, redialer, worker):
+	while True:
+		item = redialer.Jobs.dequeue(timeout=1)
+		if item is None:
+			return
+		start = time.time()
+		worker.run_job(*item)
+		recorder.add('worker_job', time.time() - start)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark simulated call flows against the redialer webhooks offline.')
+	parser.add_argument('--calls', type=int, default=100, help='total number of simulated calls')
+	parser.add_argument('--concurrency', type=int, default=10, help='number of concurrent simulated callers')
+	parser.add_argument('--busy-cycles', type=int, default=5, help='busy signals before each call connects')
+	parser.add_argument('--zip', default='20500', help='ZIP code the simulated callers enter')
+	parser.add_argument('--redis-db', type=int, default=15, help='Redis database to use (default: 15)')
+	parser.add_argument('--fakeredis', action='store_true', help='use an in-process fakeredis server instead of Redis')
+	args = parser.parse_args()
+
+	if args.fakeredis:
+		import fakeredis
+		import redisclient
+		server = fakeredis.FakeServer()
+		redisclient.connect = lambda conn_args={}: fakeredis.FakeStrictRedis(server=server)
+
+	load_config(args.redis_db)
+	import redialer
+	import worker
+
+	# don't let pacing meant for the real switchboards dominate the measurement
+	redialer.OutboundRate.rate = redialer.OutboundRate.burst = 10 ** 9
+	redialer.Scheduler.backoff_base = 0
+	redialer.Scheduler.max_in_flight = args.calls
+
+	counter = RedisCounter()
+	counter.install()
+	recorder = Recorder()
+
+	calls = iter(range(args.calls))
+	calls_lock = threading.Lock()
+	errors = []
+
+	def run_caller():
+		client = redialer.app.test_client()
+		while True:
+			with calls_lock:
+				call = next(calls, None)
+			if call is None:
+				return
+			try:
+				simulate_call(client, recorder, redialer, worker, '+1555{0:07d}'.format(call), args.zip, args.busy_cycles)
+			except Exception as e:
+				errors.append(e)
+
+	start = time.time()
+	threads = [threading.Thread(target=run_caller) for i in range(args.concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	drain_jobs(recorder, redialer, worker)
+	elapsed = time.time() - start
+
+	completed = args.calls - len(errors)
+	requests = sum(len(values) for route, values in recorder.latencies.items() if route not in ('dispatch', 'worker_job'))
+
+	print('{0:<20} {1:>8} {2:>10} {3:>10}'.format('route', 'count', 'p50 ms', 'p99 ms'))
+	for route, values in sorted(recorder.latencies.items()):
+		print('{0:<20} {1:>8} {2:>10.2f} {3:>10.2f}'.format(route, len(values), 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.99)))
+	print('')
+	print('calls: {0} completed, {1} failed in {2:.2f}s'.format(completed, len(errors), elapsed))
+	print('throughput: {0:.1f} calls/s, {1:.1f} webhook requests/s at concurrency {2}'.format(completed / elapsed, requests / elapsed, args.concurrency))
+	print('redis per call: {0:.1f} commands in {1:.1f} round trips'.format(float(counter.commands) / max(completed, 1), float(counter.round_trips) / max(completed, 1)))
+	print('rate limiter: {0}'.format(redialer.OutboundRate.get_counters()))
+	for e in errors[:5]:
+		sys.stderr.write('error: {0!r}\n'.format(e))
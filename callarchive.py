@@ -0,0 +1,42 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+
+class CallArchive(object):
+	'''
+	Append-only archive of finished call records as gzipped JSON lines, one
+	file per day and process so concurrent workers never interleave writes.
+	Each record is written as its own gzip member, so files stay readable
+	(e.g. with zcat) even if a process dies mid-write.
+	'''
+
+	FILE_NAME = 'calls-{0}-{1}.jsonl.gz'
+
+	def __init__(self, directory='archive'):
+		self.directory = directory
+		self.lock = threading.Lock()
+
+	def get_path(self, day=None):
+		'''
+		Return the path of this process's archive file for a day (default: today, UTC)
+		'''
+		if day is None:
+			day = datetime.datetime.utcnow().date()
+		return os.path.join(self.directory, self.__class__.FILE_NAME.format(day.isoformat(), os.getpid()))
+
+	def append(self, record):
+		'''
+		Append a record to the archive
+		'''
+		line = json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+		with self.lock:
+			if not os.path.isdir(self.directory):
+				try:
+					os.makedirs(self.directory)
+				except OSError:
+					# another process created it first
+					pass
+			with gzip.open(self.get_path(), 'ab') as archive_file:
+				archive_file.write(line.encode('utf-8'))
@@ -0,0 +1,112 @@
+import collections
+import os
+import threading
+import time
+import redisclient
+
+class CallerCache(object):
+	'''
+	Bounded, thread-safe LRU cache of caller data (e.g. their ZIP code), so
+	the several webhooks of one call read it from Redis once per worker.
+	Entries expire after ttl seconds. Writers publish the caller's number on
+	a Redis channel, and every process evicts its copy when it hears it; while
+	a process isn't subscribed it bypasses the cache, as it could miss those.
+	'''
+
+	CHANNEL = 'caller:invalidate'
+
+	def __init__(self, conn_args={}, max_size=10000, ttl=60):
+		self.conn_args = conn_args
+		self.max_size = max_size
+		self.ttl = ttl
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		# bumped on every eviction, so a load racing an eviction isn't cached
+		self.generation = 0
+		self.subscribed = False
+		self.listener_pid = None
+
+		self.cache = redisclient.connect(self.conn_args)
+
+	def get(self, number, load):
+		'''
+		Return the cached data for a caller, calling load() to read and cache
+		it on a miss
+		'''
+		self.start_listener()
+		if not self.subscribed:
+			return load()
+
+		with self.lock:
+			if number in self.entries:
+				expires_at, data = self.entries.pop(number)
+				if expires_at > time.time():
+					self.entries[number] = (expires_at, data)
+					return dict(data)
+			generation = self.generation
+
+		data = load()
+
+		with self.lock:
+			if generation == self.generation and self.subscribed:
+				self.entries[number] = (time.time() + self.ttl, dict(data))
+				while len(self.entries) > self.max_size:
+					self.entries.popitem(last=False)
+		return data
+
+	def invalidate(self, number, client=None):
+		'''
+		Drop a caller's data here and tell every other process to drop it.
+		Pass a pipeline as client to publish once its writes are sent.
+		'''
+		self.evict(number)
+		(client or self.cache).publish(self.__class__.CHANNEL, number)
+
+	def evict(self, number):
+		'''
+		Drop a caller's data from this process's cache
+		'''
+		with self.lock:
+			self.generation += 1
+			self.entries.pop(number, None)
+
+	def clear(self):
+		'''
+		Drop every cached caller
+		'''
+		with self.lock:
+			self.generation += 1
+			self.entries.clear()
+
+	def start_listener(self):
+		'''
+		Subscribe to invalidations in a background thread. Safe to call on
+		every request: it starts one thread per process, including after a fork.
+		'''
+		if self.listener_pid == os.getpid():
+			return
+		self.listener_pid = os.getpid()
+		self.subscribed = False
+		self.clear()
+
+		def listen():
+			while True:
+				try:
+					pubsub = redisclient.connect(self.conn_args).pubsub(ignore_subscribe_messages=True)
+					pubsub.subscribe(self.__class__.CHANNEL)
+					self.subscribed = True
+					for message in pubsub.listen():
+						self.evict(message['data'])
+				except Exception:
+					pass
+				# invalidations may have been missed while disconnected
+				self.subscribed = False
+				self.clear()
+				time.sleep(1)
+
+		thread = threading.Thread(target=listen)
+		thread.daemon = True
+		thread.start()
+
+	def __len__(self):
+		return len(self.entries)
@@ -1,5 +1,15 @@
-import redis
+import copy
+import contextlib
+import time
+import redisclient
+import metrics
 
+@metrics.registry.timed_methods('redialer_state_seconds', exclude=(
+	'batch', 'iter_call_records',
+	'get_data_key', 'get_attempts_key', 'get_origin_key', 'get_query_key', 'get_caller_key', 'get_status_key', 'get_callbacks_key',
+	'get_bridge_key',
+	'get_cost_cents', 'build_call_record', 'format_key'
+))
 class CallStateManager(object):
 	
 	KEY_DATA = 'call:{0}:data'
@@ -7,37 +17,237 @@ class CallStateManager(object):
 	KEY_ORIGIN = 'call:{0}:origin'
 	KEY_QUERY = 'call:{0}:query'
 	KEY_CALLER_DATA = 'caller:{0}:data'
+	KEY_STATUS = 'call:{0}:status'
+	KEY_CALLBACKS = 'call:{0}:callbacks'
+	KEY_BRIDGE = 'call:{0}:bridge'
 
-	def __init__(self, conn_args={}, ttl=3600):
+	# Key name patterns of the layout without hash tags, for migrate_keys
+	UNTAGGED_KEY_PATTERNS = ['call:*', 'caller:*']
+
+	# Call statuses from which a call can still connect or be hung up
+	ACTIVE_STATUSES = ['queued', 'initiated', 'ringing', 'in-progress']
+
+	# How far along a call is in each status; every final status ranks last
+	LUA_STATUS_RANKS = '''
+		local ranks = {
+			['queued'] = 1, ['initiated'] = 1, ['ringing'] = 2, ['in-progress'] = 3,
+			['completed'] = 4, ['busy'] = 4, ['no-answer'] = 4, ['canceled'] = 4, ['failed'] = 4
+		}
+	'''
+
+	# Record a call status reported by a status callback, unless the stored
+	# status is already as far along. Callbacks can arrive out of order.
+	# KEYS: status key; ARGV: status, TTL
+	SCRIPT_SET_STATUS = LUA_STATUS_RANKS + '''
+		local current = redis.call('GET', KEYS[1])
+		if current and (ranks[current] or 0) >= (ranks[ARGV[1]] or 0) then
+			return current
+		end
+		redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+		return ARGV[1]
+	'''
+
+	# Record a status callback once per (status, sequence number), and set the
+	# status as SCRIPT_SET_STATUS does. Return 1 only if this callback moved
+	# the call forward, or 0 for a redelivery or one that arrived too late,
+	# so a webhook acts on each transition (e.g. a busy signal) only once.
+	# KEYS: status, callbacks; ARGV: status, sequence number, TTL
+	SCRIPT_RECORD_CALLBACK = LUA_STATUS_RANKS + '''
+		local added = redis.call('SADD', KEYS[2], ARGV[1] .. ':' .. ARGV[2])
+		redis.call('EXPIRE', KEYS[2], ARGV[3])
+		if added == 0 then
+			return 0
+		end
+		local current = redis.call('GET', KEYS[1])
+		if current and (ranks[current] or 0) >= (ranks[ARGV[1]] or 0) then
+			return 0
+		end
+		redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+		return 1
+	'''
+
+	# Read everything a webhook needs about a call in one round trip. Resolves
+	# the inbound SID from an outbound SID's origin key when needed.
+	# ARGV: key templates (data, attempts, origin, caller, status), inbound SID,
+	# outbound SID, inbound number (empty strings when unknown)
+	SCRIPT_GET_CONTEXT = '''
+		local inbound_sid = ARGV[6]
+		local origin = false
+		if ARGV[7] ~= '' then
+			origin = redis.call('GET', (string.gsub(ARGV[3], '{0}', ARGV[7])))
+			if inbound_sid == '' and origin then
+				inbound_sid = origin
+			end
+		end
+		local data = {}
+		local last_attempt = false
+		local status = false
+		local last_attempt_status = false
+		if inbound_sid ~= '' then
+			data = redis.call('HGETALL', (string.gsub(ARGV[1], '{0}', inbound_sid)))
+			last_attempt = redis.call('LINDEX', (string.gsub(ARGV[2], '{0}', inbound_sid)), 0)
+			status = redis.call('GET', (string.gsub(ARGV[5], '{0}', inbound_sid)))
+			if last_attempt then
+				last_attempt_status = redis.call('GET', (string.gsub(ARGV[5], '{0}', last_attempt)))
+			end
+		end
+		local caller_data = {}
+		if ARGV[8] ~= '' then
+			caller_data = redis.call('HGETALL', (string.gsub(ARGV[4], '{0}', ARGV[8])))
+		end
+		return {inbound_sid, origin, data, last_attempt, caller_data, status, last_attempt_status}
+	'''
+
+	# Collapse a finished inbound call's keys, which share a cluster slot when
+	# hash tags are on, into one record and delete them. The status is kept
+	# until it expires, so callbacks redelivered after archival are still
+	# recognized (see SCRIPT_RECORD_CALLBACK).
+	# KEYS: data, attempts, query, bridge, status
+	SCRIPT_ARCHIVE = '''
+		local data = redis.call('HGETALL', KEYS[1])
+		local attempts = redis.call('LRANGE', KEYS[2], 0, -1)
+		local status = redis.call('GET', KEYS[5])
+		redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+		return {data, attempts, status or ''}
+	'''
+
+	def __init__(self, conn_args={}, ttl=3600, caller_ttl=None, hash_tags=False, caller_cache=None):
 		self.conn_args = conn_args
+		# live call keys expire after ttl seconds without writes, and caller
+		# data (e.g. their ZIP code) after caller_ttl, if set
 		self.ttl = ttl
+		self.caller_ttl = caller_ttl
+		self.batching = False
+		# Redis Cluster only runs multi-key commands and scripts on keys in
+		# one slot, so wrap each SID or number in a hash tag: every key for a
+		# call (or caller) then lands in the same slot, e.g. call:{CA123}:data.
+		# An outbound SID's origin and status keys share its own slot, so
+		# looking up the inbound SID is a single-key read.
+		self.cluster = redisclient.is_cluster(conn_args)
+		self.hash_tags = hash_tags or self.cluster
+		# optional in-process CallerCache in front of get_caller_data
+		self.caller_cache = caller_cache
+
+		self.cache = redisclient.connect(self.conn_args)
+		self.get_context_script = self.cache.register_script(self.__class__.SCRIPT_GET_CONTEXT)
+		self.set_status_script = self.cache.register_script(self.__class__.SCRIPT_SET_STATUS)
+		self.record_callback_script = self.cache.register_script(self.__class__.SCRIPT_RECORD_CALLBACK)
+		self.archive_script = self.cache.register_script(self.__class__.SCRIPT_ARCHIVE)
+
+	@contextlib.contextmanager
+	def batch(self):
+		'''
+		Yield a manager whose writes are queued and sent to Redis as a single
+		atomic MULTI/EXEC round trip on exit. Nested batches join the outer one.
+		Reads made through the yielded manager return nothing useful.
+		On a cluster the writes are pipelined to each node without MULTI/EXEC.
+		'''
+		if self.batching:
+			yield self
+			return
 
-		self.cache = redis.StrictRedis(**self.conn_args)
+		batch = copy.copy(self)
+		batch.batching = True
+		batch.cache = self.cache.pipeline(transaction=not self.cluster)
+		yield batch
+		batch.cache.execute()
+
+	def get_context(self, inbound_sid=None, outbound_sid=None, inbound_number=None):
+		'''
+		Get call data, origin, last attempt, caller data and the statuses of the
+		inbound call and last attempt in one round trip.
+		Pass an outbound SID instead of the inbound SID to look up its origin.
+		On a cluster this takes up to three round trips, as the keys span slots.
+		'''
+		if self.cluster:
+			return self.get_context_by_slot(inbound_sid, outbound_sid, inbound_number)
+
+		# templates with any hash tags applied, e.g. call:{{0}}:data
+		result = self.get_context_script(args=[
+			self.get_data_key('{0}'), self.get_attempts_key('{0}'), self.get_origin_key('{0}'),
+			self.get_caller_key('{0}'), self.get_status_key('{0}'),
+			inbound_sid or '', outbound_sid or '', inbound_number or ''
+		])
+		inbound_sid, origin, data, last_attempt, caller_data, status, last_attempt_status = result
+		return {
+			'inbound_sid': inbound_sid or None,
+			'origin': origin,
+			'data': dict(zip(data[::2], data[1::2])),
+			'last_attempt': last_attempt,
+			'caller_data': dict(zip(caller_data[::2], caller_data[1::2])),
+			'status': status,
+			'last_attempt_status': last_attempt_status,
+		}
+
+	def get_context_by_slot(self, inbound_sid=None, outbound_sid=None, inbound_number=None):
+		'''
+		Get the same context as get_context, reading each slot's keys separately
+		'''
+		origin = self.get_origin(outbound_sid) if outbound_sid else None
+		inbound_sid = inbound_sid or origin
+
+		pipe = self.cache.pipeline(transaction=False)
+		if inbound_sid:
+			pipe.hgetall(self.get_data_key(inbound_sid))
+			pipe.lindex(self.get_attempts_key(inbound_sid), 0)
+			pipe.get(self.get_status_key(inbound_sid))
+		if inbound_number:
+			pipe.hgetall(self.get_caller_key(inbound_number))
+		results = pipe.execute()
+
+		data, last_attempt, status = results[:3] if inbound_sid else ({}, None, None)
+		caller_data = results[-1] if inbound_number else {}
+		return {
+			'inbound_sid': inbound_sid,
+			'origin': origin,
+			'data': data,
+			'last_attempt': last_attempt,
+			'caller_data': caller_data,
+			'status': status,
+			'last_attempt_status': self.get_status(last_attempt) if last_attempt else None,
+		}
+
+	def format_key(self, template, sid):
+		'''
+		Fill a key template with a SID or number, in a hash tag if enabled
+		'''
+		if self.hash_tags:
+			sid = '{' + sid + '}'
+		return template.format(sid)
 
 	def get_data_key(self, inbound_sid):
 		'''
 		Return the key for the data cache entry
 		'''
-		return self.__class__.KEY_DATA.format(inbound_sid)
+		return self.format_key(self.__class__.KEY_DATA, inbound_sid)
 
 	def get_attempts_key(self, inbound_sid):
 		'''
 		Return the key for the attempts cache entry
 		'''
-		return self.__class__.KEY_ATTEMPTS.format(inbound_sid)
+		return self.format_key(self.__class__.KEY_ATTEMPTS, inbound_sid)
 
 	def set_data(self, inbound_sid, **fields):
 		'''
 		Store the outbound destination number for an inbound SID
 		'''
 		key = self.get_data_key(inbound_sid)
-		self.cache.hmset(key, fields)
+		with self.batch() as batch:
+			batch.cache.hmset(key, fields)
+			batch.cache.expire(key, self.ttl)
+
+	def has_data(self, inbound_sid):
+		'''
+		Whether data is still stored for an inbound SID, i.e. it hasn't been
+		archived or expired
+		'''
+		return bool(self.cache.exists(self.get_data_key(inbound_sid)))
 
 	def get_origin_key(self, outbound_sid):
 		'''
 		Return the key for the origin cache entry
 		'''
-		return self.__class__.KEY_ORIGIN.format(outbound_sid)
+		return self.format_key(self.__class__.KEY_ORIGIN, outbound_sid)
 
 	def get_origin(self, outbound_sid):
 		'''
@@ -54,11 +264,57 @@ class CallStateManager(object):
 		self.cache.set(key, inbound_sid, ex=self.ttl)
 
 
+	def get_status_key(self, call_sid):
+		'''
+		Return the key for the call status cache entry
+		'''
+		return self.format_key(self.__class__.KEY_STATUS, call_sid)
+
+	def get_status(self, call_sid):
+		'''
+		Get the last known status of a call, as reported by its status callbacks
+		'''
+		key = self.get_status_key(call_sid)
+		return self.cache.get(key)
+
+	def set_status(self, call_sid, status):
+		'''
+		Record a call status, ignoring any that would move the call backwards
+		(e.g. a late "ringing" callback after "completed")
+		'''
+		key = self.get_status_key(call_sid)
+		if self.batching and self.cluster:
+			# cluster pipelines refuse EVALSHA, so send the script itself
+			return self.cache.eval(self.__class__.SCRIPT_SET_STATUS, 1, key, status, self.ttl)
+		return self.set_status_script(keys=[key], args=[status, self.ttl], client=self.cache)
+
+	def get_callbacks_key(self, call_sid):
+		'''
+		Return the key for the set of status callbacks received for a call
+		'''
+		return self.format_key(self.__class__.KEY_CALLBACKS, call_sid)
+
+	def record_callback(self, call_sid, status, sequence_number=None):
+		'''
+		Record a status callback and return whether it moved the call forward.
+		Return False for a callback Twilio delivered again (the same status and
+		SequenceNumber) or one that arrived after a later status, which should
+		not be acted on.
+		'''
+		keys = [self.get_status_key(call_sid), self.get_callbacks_key(call_sid)]
+		return bool(self.record_callback_script(keys=keys, args=[status, sequence_number or '', self.ttl], client=self.cache))
+
+	def is_active(self, call_sid):
+		'''
+		Whether a call is known to still be able to connect
+		'''
+		return self.get_status(call_sid) in self.__class__.ACTIVE_STATUSES
+
 	def get_query_key(self, inbound_sid):
 		'''
 		Return the key for the inbound SID search query
 		'''
-		return self.__class__.KEY_QUERY.format(inbound_sid)
+		return self.format_key(self.__class__.KEY_QUERY, inbound_sid)
 
 	def get_query(self, inbound_sid):
 		'''
@@ -94,23 +350,213 @@ class CallStateManager(object):
 		'''
 		data_key = self.get_data_key(inbound_sid)
 		attempts_key = self.get_attempts_key(inbound_sid)
-		self.cache.hmset(data_key, {'to': outbound_call.to, 'last_attempt': outbound_call.sid})
-		self.cache.hincrby(data_key, 'attempts', 1)
-		self.cache.lpush(attempts_key, outbound_call.sid)
-		self.set_origin(outbound_call.sid, inbound_sid)
+		with self.batch() as batch:
+			batch.cache.hmset(data_key, {'to': outbound_call.to, 'last_attempt': outbound_call.sid})
+			batch.cache.hincrby(data_key, 'attempts', 1)
+			batch.cache.lpush(attempts_key, outbound_call.sid)
+			batch.cache.expire(data_key, self.ttl)
+			batch.cache.expire(attempts_key, self.ttl)
+			batch.set_origin(outbound_call.sid, inbound_sid)
+			batch.set_status(outbound_call.sid, outbound_call.status or 'queued')
+
+	def get_active_attempts(self, inbound_sid):
+		'''
+		Return the SIDs of an inbound call's outbound attempts that are still
+		queued, ringing or connected, in two round trips
+		'''
+		attempts = self.cache.lrange(self.get_attempts_key(inbound_sid), 0, -1)
+		pipe = self.cache.pipeline(transaction=False)
+		for attempt_sid in attempts:
+			pipe.get(self.get_status_key(attempt_sid))
+		statuses = pipe.execute()
+		return [attempt_sid for attempt_sid, status in zip(attempts, statuses) if status in self.__class__.ACTIVE_STATUSES]
+
+	def get_bridge_key(self, inbound_sid):
+		'''
+		Return the key for the outbound SID bridged into an inbound call
+		'''
+		return self.format_key(self.__class__.KEY_BRIDGE, inbound_sid)
+
+	def get_bridge(self, inbound_sid):
+		'''
+		Get the outbound SID bridged into an inbound call, if any
+		'''
+		return self.cache.get(self.get_bridge_key(inbound_sid))
+
+	def claim_bridge(self, inbound_sid, outbound_sid):
+		'''
+		Record an answered outbound call as the one bridged into an inbound
+		call, unless another already is. Return whether it was recorded, so
+		when several offices are dialed at once only the first to answer joins.
+		'''
+		key = self.get_bridge_key(inbound_sid)
+		return bool(self.cache.set(key, outbound_sid, nx=True, ex=self.ttl)) or self.cache.get(key) == outbound_sid
 
 	def add_cost(self, inbound_sid, cost_usd):
 		'''
 		Capture cost data
 		'''
-		if cost_usd is None:
+		cost_cents = self.get_cost_cents(cost_usd)
+		if cost_cents is None:
 			return
+		key = self.get_data_key(inbound_sid)
+		with self.batch() as batch:
+			batch.cache.hincrby(key, 'cost', cost_cents)
+			batch.cache.expire(key, self.ttl)
+
+	def get_cost_cents(self, cost_usd):
+		'''
+		Convert a Twilio price in dollars to cents, or None if there isn't one
+		'''
+		if cost_usd is None:
+			return None
 		try:
-			cost_cents = int(100 * float(cost_usd))
-			key = self.get_data_key(inbound_sid)
-			self.cache.hincrby(key, 'cost', cost_cents)
+			return int(100 * float(cost_usd))
 		except ValueError as e:
-			pass
+			return None
+
+	def archive_call(self, inbound_sid):
+		'''
+		Remove a finished call's data, attempts, query and bridge from Redis in
+		one step, and read its and its attempts' statuses. Return them as a
+		single compact record, or None if nothing was stored. Status, callbacks
+		and the attempts' origin keys are left to expire, as callbacks (e.g. a
+		price to capture, or a redelivery to ignore) may still be on the way.
+		'''
+		keys = [
+			self.get_data_key(inbound_sid), self.get_attempts_key(inbound_sid), self.get_query_key(inbound_sid),
+			self.get_bridge_key(inbound_sid), self.get_status_key(inbound_sid)
+		]
+		data, attempts, status = self.archive_script(keys=keys, client=self.cache)
+		if not data and not attempts:
+			return None
+
+		# each attempt's keys are in the attempt's own slot
+		pipe = self.cache.pipeline(transaction=False)
+		for attempt_sid in attempts:
+			pipe.get(self.get_status_key(attempt_sid))
+		attempt_statuses = pipe.execute()
+
+		return self.build_call_record(inbound_sid, dict(zip(data[::2], data[1::2])), attempts, status, attempt_statuses)
+
+	def build_call_record(self, inbound_sid, data, attempts, status, attempt_statuses):
+		'''
+		Combine a call's stored data, attempts (newest first, as stored) and
+		statuses into a single compact record
+		'''
+		record = dict(data)
+		for field in ('attempts', 'cost'):
+			if field in record:
+				record[field] = int(record[field])
+		record.pop('last_attempt', None)
+		record['sid'] = inbound_sid
+		record['status'] = status or None
+		# oldest attempt first
+		record['attempt_sids'] = list(reversed(attempts))
+		record['attempt_statuses'] = [attempt_status or None for attempt_status in reversed(attempt_statuses)]
+		return record
+
+	def get_call_records(self, inbound_sids):
+		'''
+		Get records (as built by build_call_record) for a batch of calls
+		in two pipelined round trips
+		'''
+		pipe = self.cache.pipeline(transaction=False)
+		for inbound_sid in inbound_sids:
+			pipe.hgetall(self.get_data_key(inbound_sid))
+			pipe.lrange(self.get_attempts_key(inbound_sid), 0, -1)
+			pipe.get(self.get_status_key(inbound_sid))
+		results = pipe.execute()
+		calls = [results[i:i + 3] for i in range(0, len(results), 3)]
+
+		pipe = self.cache.pipeline(transaction=False)
+		for data, attempts, status in calls:
+			for attempt_sid in attempts:
+				pipe.get(self.get_status_key(attempt_sid))
+		attempt_statuses = iter(pipe.execute())
+
+		records = []
+		for inbound_sid, (data, attempts, status) in zip(inbound_sids, calls):
+			statuses = [next(attempt_statuses) for attempt_sid in attempts]
+			if data or attempts:
+				# skip calls archived or expired since they were found
+				records.append(self.build_call_record(inbound_sid, data, attempts, status, statuses))
+		return records
+
+	def get_orphaned_attempts(self, outbound_sids):
+		'''
+		Return the outbound SIDs, of those given, that have no origin or whose
+		inbound call is no longer active, in two pipelined round trips
+		'''
+		pipe = self.cache.pipeline(transaction=False)
+		for outbound_sid in outbound_sids:
+			pipe.get(self.get_origin_key(outbound_sid))
+		origins = pipe.execute()
+
+		pipe = self.cache.pipeline(transaction=False)
+		for origin in origins:
+			if origin:
+				pipe.get(self.get_status_key(origin))
+		statuses = iter(pipe.execute())
+
+		orphans = []
+		for outbound_sid, origin in zip(outbound_sids, origins):
+			if not origin or next(statuses) not in self.__class__.ACTIVE_STATUSES:
+				orphans.append(outbound_sid)
+		return orphans
+
+	def iter_call_records(self, batch_size=500, pause=0):
+		'''
+		Yield records for every call stored in Redis. Keys are found with SCAN
+		and read in pipelined batches so Redis is never blocked for long;
+		pause (in seconds) between batches to lighten the load further.
+		'''
+		prefix, suffix = self.get_data_key('\0').split('\0')
+		inbound_sids = []
+		for key in self.cache.scan_iter(match=self.get_data_key('*'), count=batch_size):
+			inbound_sids.append(key[len(prefix):len(key) - len(suffix)])
+			if len(inbound_sids) >= batch_size:
+				for record in self.get_call_records(inbound_sids):
+					yield record
+				inbound_sids = []
+				time.sleep(pause)
+		if inbound_sids:
+			for record in self.get_call_records(inbound_sids):
+				yield record
+
+	def migrate_keys(self, batch_size=500):
+		'''
+		Rename keys from the layout without hash tags to the hash-tagged one,
+		keeping their TTLs. Run on a single Redis node (a rename can't move a
+		key between cluster slots) before switching on hash_tags or moving the
+		data to a cluster. Return the number of keys renamed.
+		'''
+		if not self.hash_tags or self.cluster:
+			raise ValueError('migrate_keys needs hash tags on and a single Redis node')
+
+		renamed = 0
+		for pattern in self.__class__.UNTAGGED_KEY_PATTERNS:
+			keys = []
+			for key in self.cache.scan_iter(match=pattern, count=batch_size):
+				if '{' not in key:
+					keys.append(key)
+				if len(keys) >= batch_size:
+					renamed += self.rename_untagged_keys(keys)
+					keys = []
+			renamed += self.rename_untagged_keys(keys)
+		return renamed
+
+	def rename_untagged_keys(self, keys):
+		'''
+		Rename a batch of keys like call:CA123:data to call:{CA123}:data
+		'''
+		if not keys:
+			return 0
+		pipe = self.cache.pipeline(transaction=False)
+		for key in keys:
+			prefix, sid, suffix = key.split(':', 2)
+			pipe.renamenx(key, '{0}:{{{1}}}:{2}'.format(prefix, sid, suffix))
+		return sum(1 for renamed in pipe.execute() if renamed)
 
 	def get_last_attempt(self, inbound_sid):
 		'''
@@ -120,12 +566,38 @@ class CallStateManager(object):
 		return self.cache.lindex(attempts_key, 0)
 
 	def get_caller_key(self, inbound_number):
-		return self.__class__.KEY_CALLER_DATA.format(inbound_number)
+		return self.format_key(self.__class__.KEY_CALLER_DATA, inbound_number)
 
 	def get_caller_data(self, inbound_number):
 		key = self.get_caller_key(inbound_number)
-		return self.cache.hgetall(key)
+		if self.caller_cache is None:
+			return self.cache.hgetall(key)
+		return self.caller_cache.get(inbound_number, lambda: self.cache.hgetall(key))
 
 	def set_caller_data(self, inbound_number, **fields):
 		key = self.get_caller_key(inbound_number)
-		self.cache.hmset(key, fields)
+		with self.batch() as batch:
+			batch.cache.hmset(key, fields)
+			if self.caller_ttl:
+				batch.cache.expire(key, self.caller_ttl)
+			if self.caller_cache is not None and not self.cluster:
+				# published with the write, so no process reloads the old data
+				self.caller_cache.invalidate(inbound_number, client=batch.cache)
+		if self.caller_cache is not None and self.cluster:
+			# cluster pipelines can't publish, so publish once the write is sent
+			self.caller_cache.invalidate(inbound_number)
+
+if __name__ == "__main__":
+	import argparse
+	import config
+
+	parser = argparse.ArgumentParser(description='Manage call state stored in Redis.')
+	parser.add_argument('--migrate-keys', action='store_true',
+		help='rename keys to the hash-tagged layout used with REDIS_HASH_TAGS or a Redis Cluster')
+	args = parser.parse_args()
+
+	if args.migrate_keys:
+		call_state = CallStateManager(conn_args=config.REDIS_CLIENT_KWARGS, hash_tags=True)
+		print('renamed {0} keys'.format(call_state.migrate_keys()))
+	else:
+		parser.print_help()
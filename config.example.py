@@ -22,12 +22,120 @@ TWILIO_VOICE = 'woman'
 TWILIO_DEFAULT_FROM = '+12025551234'
 
 # Redis connection constructor arguments
-# (https://redis-py.readthedocs.io/en/latest/#redis.Redis)
+# (https://redis-py.readthedocs.io/en/latest/#redis.Redis). Add
+# 'cluster': True to connect to a Redis Cluster through one of its nodes
+# (needs the redis-py-cluster 2.x package).
+# Each process shares one pool of up to max_connections connections, waiting
+# up to pool_timeout seconds for a free one, and checks connections idle for
+# health_check_interval seconds before reusing them.
 REDIS_CLIENT_KWARGS = {
 	'host': 'localhost',
 	'port': 6379,
-	'db': 0
+	'db': 0,
+	'max_connections': 50,
+	'pool_timeout': 5,
+	'health_check_interval': 30
 }
 
-# TTL to use for more transient Redis data
-REDIS_TTL = 60 * 60 * 2
\ No newline at end of file
+# Wrap call SIDs and numbers in Redis keys in hash tags, e.g. call:{CA123}:data,
+# so each call's keys share a cluster slot. Always on for a cluster; run
+# `python callstatemanager.py --migrate-keys` before switching it on.
+REDIS_HASH_TAGS = False
+
+# TTL to use for more transient Redis data, including live call records
+REDIS_TTL = 60 * 60 * 2
+
+# Use an in-memory stand-in for the Twilio REST client so the app and
+# worker can be run offline
+TWILIO_STUB = False
+
+# Number of threads the background worker (worker.py) uses to run queued
+# Twilio API jobs: retries, price lookups and hangups
+WORKER_THREADS = 4
+
+# Redial scheduler settings (see redialscheduler.RedialScheduler):
+# - max_in_flight: concurrent outbound attempts allowed per destination number
+# - backoff_base, backoff_max: seconds to wait before a redial, doubling with
+#   each attempt up to the maximum
+# - backoff_jitter: fraction of each wait randomly shaved off so redials to
+#   the same office don't fire in lockstep
+REDIAL_SCHEDULER_KWARGS = {
+	'max_in_flight': 3,
+	'backoff_base': 5,
+	'backoff_max': 120,
+	'backoff_jitter': 0.5
+}
+
+# Seconds between the worker's checks for scheduled redials that are due
+REDIAL_DISPATCH_INTERVAL = 1
+
+# Account-wide outbound call rate limit shared by all workers and nodes
+# (see ratelimiter.RateLimiter); match it to the Twilio account's CPS limit:
+# - rate: calls per second
+# - burst: calls allowed at once after a quiet period
+# - max_wait: seconds a call may wait for the limit before it's rescheduled
+OUTBOUND_RATE_LIMIT_KWARGS = {
+	'rate': 1,
+	'burst': 1,
+	'max_wait': 10
+}
+
+# Maximum number of rendered TwiML responses (e.g. the member menu for each
+# ZIP code) each worker keeps cached
+TWIML_CACHE_SIZE = 1024
+
+# Seconds each process buffers latency metrics before adding them to the
+# totals in Redis that the /metrics endpoint exports
+METRICS_FLUSH_INTERVAL = 5
+
+# Seconds between each worker's checks of the local roster snapshot
+# (members.json) for a new version to swap in
+MEMBERS_REFRESH_INTERVAL = 60
+
+# Seconds between downloads of the roster by the background worker
+# (worker.py) to update the local snapshot; None to only update it by
+# running `python congress.py --snapshot`
+MEMBERS_DOWNLOAD_INTERVAL = 60 * 60 * 24
+
+# TTL for caller data such as their last ZIP code, or None to keep it forever
+REDIS_CALLER_TTL = 60 * 60 * 24 * 365
+
+# In-process cache of caller data (e.g. ZIP codes) read by the webhooks:
+# the most callers kept per process and seconds to keep each. Writes evict
+# cached copies in every process through Redis pub/sub.
+CALLER_CACHE_KWARGS = {
+	'max_size': 10000,
+	'ttl': 60
+}
+
+# Directory the background worker archives finished call records to, as
+# gzipped JSON lines (calls-<date>-<pid>.jsonl.gz), after removing them from Redis
+CALL_ARCHIVE_DIR = 'archive'
+
+# Record every incoming webhook to this file for replay.py, or None to disable
+WEBHOOK_TRACE_FILE = None
+
+# Call lifecycle event stream: the number of events kept, seconds to keep
+# each call's folded summary, and seconds before a stopped consumer's
+# unacknowledged events are taken over by another
+EVENT_LOG_KWARGS = {
+	'max_length': 1000000,
+	'summary_ttl': 60 * 60 * 24 * 7,
+	'min_idle_time': 60
+}
+
+# Number of threads each worker process runs to fold events into summaries
+EVENT_CONSUMERS = 1
+
+# Seconds between checks of Twilio's queued and ringing outbound calls for
+# legs whose caller has hung up, which the worker then hangs up, or None to
+# disable. Legs younger than REAPER_GRACE seconds are never hung up.
+REAPER_INTERVAL = 60
+REAPER_GRACE = 60
+
+# Keep-alive HTTP connections to the Twilio REST API per process: the most
+# requests sent at once, and the socket timeout in seconds
+TWILIO_HTTP_POOL_KWARGS = {
+	'size': 10,
+	'timeout': 30
+}
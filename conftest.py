@@ -0,0 +1,12 @@
+import fakeredis
+import pytest
+import redisclient
+
+# Every client the modules under test create talks to one fakeredis server,
+# which runs the Lua scripts with the lupa package
+
+@pytest.fixture
+def server(monkeypatch):
+	server = fakeredis.FakeServer()
+	monkeypatch.setattr(redisclient, 'connect', lambda conn_args={}: fakeredis.FakeStrictRedis(server=server, decode_responses=True))
+	return server
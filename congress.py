@@ -1,19 +1,37 @@
 import json
+import os
 import re
+import hashlib
+import threading
+import time
+import argparse
 import utils
 import geo_data
+import metrics
 
 # A convenient list of members of Congress in CSV form
 DATA_CSV = 'http://unitedstates.sunlightfoundation.com/legislators/legislators.csv'
 
+# Path to local snapshot of the roster, so workers never download it while
+# answering a call. Carries a version so every worker converges on the same data.
+LOCAL_MEMBERS_FILE = 'members.json'
+
 # Map of title abbreviations to full names for spoken prompts
 title_map = {'Rep': 'Representative', 'Sen': 'Senator', 'Del': 'Delegate', 'Com': 'Commissioner'}
 
 # Map of title abbreviations and their relative rank/order of priority in sorted lists
 title_rank_map = {'Sen': 'A', 'Rep': 'B', 'Com': 'C', 'Del': 'D'}
 
-# capture output in a global var
-current_members = None
+# the roster in use: its version, members and the ZIP index derived from them,
+# swapped as one object so a request never mixes old and new data
+roster = None
+
+# process ID of the background refresher thread, to restart it after a fork
+refresher_pid = None
+
+# functions to call after a new roster is swapped in, e.g. to
+# invalidate anything derived from it
+reload_listeners = []
 
 def get_first_name(firstname, middlename, nickname):
 	'''
@@ -28,17 +46,27 @@ def get_first_name(firstname, middlename, nickname):
 	else:
 		return firstname
 
-def get_current_members():
+class Roster(object):
 	'''
-	Get current members of Congress as a list of standardized dicts.
+	Immutable snapshot of the members of Congress and derived indexes
 	'''
-	global current_members
+	def __init__(self, version, members):
+		self.version = version
+		self.members = members
+		self.zip_index = build_zip_index(members)
+		self.dialpad_index = build_dialpad_index(members)
 
-	state_map = geo_data.get_state_name_map()
-
-	if current_members != None:
-		return current_members
+def get_roster_version(members):
+	'''
+	Derive a version from the roster content, so identical data built on
+	different nodes gets the same version
+	'''
+	return hashlib.sha1(json.dumps(members, sort_keys=True).encode('utf-8')).hexdigest()[:12]
 
+def download_members():
+	'''
+	Download current members of Congress as a list of standardized dicts.
+	'''
 	members = []
 
 	for member in utils.csv_url_to_dicts(DATA_CSV):
@@ -57,27 +85,221 @@ def get_current_members():
 				'phone': "+1{0}".format(re.sub(r'[^0-9]', '', member['phone'])),
 				'sort': utils.remove_diacritics("{0}|{1}|{2}".format(title_rank_map[member['title']], member['lastname'], firstname))
 			})
-	current_members = members
 	return members
 
+def write_members_snapshot(members, path=LOCAL_MEMBERS_FILE):
+	'''
+	Write a versioned roster snapshot, replacing any existing one atomically.
+	Return the version.
+	'''
+	version = get_roster_version(members)
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as snapshot_file:
+		json.dump({'version': version, 'members': members}, snapshot_file, indent=2, sort_keys=True)
+	os.rename(tmp_path, path)
+	return version
+
+def read_members_snapshot(path=LOCAL_MEMBERS_FILE):
+	'''
+	Read a roster snapshot. Return its version and members.
+	'''
+	with open(path, 'r') as snapshot_file:
+		snapshot = json.load(snapshot_file)
+	return snapshot['version'], snapshot['members']
+
+def load_roster():
+	'''
+	Build a roster from the local snapshot, or from the CSV if there's none
+	'''
+	if os.path.isfile(LOCAL_MEMBERS_FILE):
+		version, members = read_members_snapshot()
+	else:
+		members = download_members()
+		version = get_roster_version(members)
+	return Roster(version, members)
+
+def get_roster():
+	'''
+	Get the roster in use, loading it on first use. Call this at startup
+	(before forking workers) so no caller waits for it.
+	'''
+	global roster
+
+	if roster == None:
+		roster = load_roster()
+	return roster
+
+def swap_roster(new_roster):
+	'''
+	Put a fully built roster in use and notify reload listeners
+	'''
+	global roster
+
+	roster = new_roster
+	for listener in reload_listeners:
+		listener()
+
+def get_current_members():
+	'''
+	Get current members of Congress as a list of standardized dicts.
+	'''
+	return get_roster().members
+
+def refresh_roster():
+	'''
+	Swap in the local snapshot if its version differs from the roster in use.
+	Return whether it changed.
+	'''
+	if not os.path.isfile(LOCAL_MEMBERS_FILE):
+		return False
+	version, members = read_members_snapshot()
+	if roster != None and roster.version == version:
+		return False
+	swap_roster(Roster(version, members))
+	return True
+
+def start_refresher(interval=60):
+	'''
+	Check the local snapshot for a new roster version every interval seconds
+	in a background thread. Safe to call on every request: it starts one
+	thread per process, including after a fork.
+	'''
+	global refresher_pid
+
+	if refresher_pid == os.getpid():
+		return
+	refresher_pid = os.getpid()
+
+	def refresh():
+		while True:
+			time.sleep(interval)
+			try:
+				refresh_roster()
+			except Exception:
+				# keep serving the current roster until a good snapshot appears
+				pass
+
+	thread = threading.Thread(target=refresh)
+	thread.daemon = True
+	thread.start()
+
+@metrics.registry.timed('redialer_search_seconds', function='build_dialpad_index')
+def build_dialpad_index(members):
+	'''
+	Build a map of every dialpad prefix (including the empty prefix) of the
+	members' last names to the sorted list of members matching it, so each
+	digit a caller enters is a single dict lookup.
+	'''
+	index = {}
+	# stable sort keeps roster order among ties, as sorting each result would
+	for member in sorted(members, key=lambda member: member['sort']):
+		for i in range(len(member['search_dial']) + 1):
+			index.setdefault(member['search_dial'][:i], []).append(member)
+	return index
+
+def get_dialpad_index():
+	'''
+	Get the dialpad prefix index for the roster in use
+	'''
+	return get_roster().dialpad_index
+
+@metrics.registry.timed('redialer_search_seconds', function='search_by_dialpad')
 def search_by_dialpad(digits):
 	'''
 	Search for members by telephone dialpad entry. Rely on precomputed dialpad equivalents for speed/simplicity.
 	'''
-	subset = [member for member in get_current_members() if member['search_dial'].startswith(re.sub(r'[^2-9]', '', digits))]
-	return sorted(subset, cmp=lambda a, b: cmp(a['sort'], b['sort']))
+	return list(get_dialpad_index().get(re.sub(r'[^2-9]', '', digits), []))
 
+class MappedZipIndex(object):
+	'''
+	ZIP prefix index over the memory-mapped ZIP data. A prefix's members are
+	found from its range of records the first time it's searched and kept,
+	so building the roster decodes no ZIP records at all.
+	'''
+	def __init__(self, records, members_by_district):
+		self.records = records
+		self.members_by_district = members_by_district
+		self.prefixes = {}
+
+	def get(self, prefix, default=None):
+		if prefix not in self.prefixes:
+			start, end = self.records.prefix_range(prefix)
+			if start == end:
+				return default
+			districts = set()
+			for i in range(start, end):
+				z = self.records.get_record(i)
+				districts.add(z['state'])
+				districts.add("{0}{1}".format(z['state'], z['cd']))
+			self.prefixes[prefix] = get_district_members(districts, self.members_by_district)
+		return self.prefixes[prefix]
+
+def get_district_members(districts, members_by_district):
+	'''
+	Get the members for a set of districts (and states, for senators), in
+	roster sort order
+	'''
+	members = []
+	for district in districts:
+		members.extend(members_by_district.get(district, []))
+	members.sort(key=lambda item: (item[1]['sort'], item[0]))
+	return [member for position, member in members]
+
+@metrics.registry.timed('redialer_search_seconds', function='build_zip_index')
+def build_zip_index(members):
+	'''
+	Build a map of every ZIP code prefix (including the empty prefix) to the
+	sorted list of members representing any ZIP starting with that prefix.
+	Built once per roster so ZIP searches are a single dict lookup. With the
+	binary ZIP data, prefixes are looked up in it as they're searched instead.
+	'''
+	# remember roster position so ties sort exactly as a stable sort of the roster would
+	members_by_district = {}
+	for position, member in enumerate(members):
+		members_by_district.setdefault(member['search_district'], []).append((position, member))
+
+	zips = geo_data.get_zip_state_cd_tuples()
+	if isinstance(zips, geo_data.ZipRecords):
+		return MappedZipIndex(zips, members_by_district)
+
+	# collect the districts (and states, for senators) reachable from each prefix
+	districts_by_prefix = {}
+	for z in zips:
+		district = "{0}{1}".format(z['state'], z['cd'])
+		for i in range(len(z['zip']) + 1):
+			districts = districts_by_prefix.setdefault(z['zip'][:i], set())
+			districts.add(z['state'])
+			districts.add(district)
+
+	index = {}
+	for prefix, districts in districts_by_prefix.items():
+		index[prefix] = get_district_members(districts, members_by_district)
+
+	return index
+
+def get_zip_index():
+	'''
+	Get the ZIP prefix index for the roster in use
+	'''
+	return get_roster().zip_index
+
+@metrics.registry.timed('redialer_search_seconds', function='search_by_zip')
 def search_by_zip(query):
+	'''
+	Search for members by full or partial ZIP code.
+	'''
 	normalized_query = re.sub(r'[^0-9]', '', str(query))
-	zip_tuples = [z for z in geo_data.get_zip_state_cd_tuples() if z['zip'].startswith(normalized_query)]
-	districts = list(set(
-		[z['state'] for z in zip_tuples]
-		+ ["{0}{1}".format(z['state'], z['cd']) for z in zip_tuples]
-	))
-	subset = [member for member in get_current_members() if member['search_district'] in districts]
-	return sorted(subset, cmp=lambda a, b: cmp(a['sort'], b['sort']))
+	return list(get_zip_index().get(normalized_query, []))
 
 if __name__ == "__main__":
-	print(json.dumps(get_current_members(), indent=2))
+	parser = argparse.ArgumentParser(description='Print the current members of Congress, or save them as the local roster snapshot.')
+	parser.add_argument('--snapshot', nargs='?', const=LOCAL_MEMBERS_FILE,
+		help='download the roster and write a snapshot (default path: {0})'.format(LOCAL_MEMBERS_FILE))
+	args = parser.parse_args()
+
+	if args.snapshot:
+		print(write_members_snapshot(download_members(), args.snapshot))
+	else:
+		print(json.dumps(get_current_members(), indent=2))
 
 
@@ -0,0 +1,183 @@
+import collections
+import datetime
+import redis
+import redisclient
+
+class EventLog(object):
+	'''
+	Append-only log of call lifecycle events in a Redis stream. Webhooks add
+	one event each (a single XADD, usually in their existing batch), and
+	consumer-group workers fold the events in batches into per-call summaries
+	and per-destination totals, so derived numbers never re-read call hashes.
+	'''
+
+	KEY_STREAM = 'events:{0}'
+	KEY_CALL_SUMMARY = 'summary:call:{0}'
+	KEY_DESTINATION_SUMMARY = 'summary:dest:{0}'
+	KEY_DESTINATIONS = 'summary:destinations'
+
+	GROUP = 'summaries'
+
+	EVENTS = ['received', 'zip_set', 'member_selected', 'attempt', 'busy', 'no_answer', 'connected', 'ended', 'cost']
+
+	# Fields each event sets on its call's summary, and counters it adds to
+	# the call's and its destination's summaries
+	SUMMARY_FIELDS = {
+		'received': {'from': 'from', 'received_at': None},
+		'zip_set': {'zip': 'zip'},
+		'member_selected': {'to': 'to', 'started_at': None},
+		'connected': {'connected_at': None},
+		'ended': {'ended_at': None, 'duration': 'duration'},
+	}
+	COUNTERS = {
+		'member_selected': 'calls',
+		'attempt': 'attempts',
+		'busy': 'busy',
+		'no_answer': 'no_answer',
+		'connected': 'connected',
+	}
+
+	def __init__(self, conn_args={}, name='calls', max_length=1000000, summary_ttl=60 * 60 * 24 * 7, min_idle_time=60):
+		self.conn_args = conn_args
+		self.name = name
+		# the stream is trimmed to about this many events
+		self.max_length = max_length
+		self.summary_ttl = summary_ttl
+		# seconds before another consumer takes over a crashed consumer's events
+		self.min_idle_time = min_idle_time
+		self.cluster = redisclient.is_cluster(conn_args)
+
+		self.cache = redisclient.connect(self.conn_args)
+
+	def get_stream_key(self):
+		'''
+		Return the key for the event stream
+		'''
+		return self.__class__.KEY_STREAM.format(self.name)
+
+	def get_call_summary_key(self, inbound_sid):
+		'''
+		Return the key for a call's summary hash
+		'''
+		return self.__class__.KEY_CALL_SUMMARY.format(inbound_sid)
+
+	def get_destination_summary_key(self, destination):
+		'''
+		Return the key for a destination number's totals hash
+		'''
+		return self.__class__.KEY_DESTINATION_SUMMARY.format(destination)
+
+	def append(self, event, inbound_sid, client=None, **fields):
+		'''
+		Add an event for an inbound call. Pass a pipeline as client to send it
+		with the webhook's other writes. Events without an inbound SID (e.g.
+		for a leg whose origin has expired) are dropped.
+		'''
+		if not inbound_sid:
+			return
+		fields = dict((name, value) for name, value in fields.items() if value is not None)
+		fields.update(event=event, sid=inbound_sid)
+		(client or self.cache).xadd(self.get_stream_key(), fields, maxlen=self.max_length, approximate=True)
+
+	def create_group(self):
+		'''
+		Create the consumer group (and stream) if they don't exist yet
+		'''
+		try:
+			self.cache.xgroup_create(self.get_stream_key(), self.__class__.GROUP, id='0', mkstream=True)
+		except redis.exceptions.ResponseError as e:
+			if 'BUSYGROUP' not in str(e):
+				raise
+
+	def consume(self, consumer, count=500, block=1):
+		'''
+		Fold the next batch of events into the summaries, waiting up to block
+		seconds for new ones. Events left unacknowledged by a consumer that
+		stopped are taken over first. Return the number of events folded.
+		'''
+		stream_key = self.get_stream_key()
+		entries = self.claim_stale(consumer, count)
+		if not entries:
+			streams = self.cache.xreadgroup(self.__class__.GROUP, consumer, {stream_key: '>'}, count=count, block=int(block * 1000))
+			entries = streams[0][1] if streams else []
+		if entries:
+			self.fold(entries)
+		return len(entries)
+
+	def claim_stale(self, consumer, count=500):
+		'''
+		Take over events delivered to a consumer but left unacknowledged for
+		longer than min_idle_time, and return them. Uses XPENDING and XCLAIM,
+		as XAUTOCLAIM needs Redis 6.2 and redis-py 4, which lacks Python 2.
+		'''
+		stream_key = self.get_stream_key()
+		min_idle_time = int(self.min_idle_time * 1000)
+		pending = self.cache.xpending_range(stream_key, self.__class__.GROUP, '-', '+', count)
+		stale = [entry['message_id'] for entry in pending if entry['time_since_delivered'] >= min_idle_time]
+		if not stale:
+			return []
+		entries = self.cache.xclaim(stream_key, self.__class__.GROUP, consumer, min_idle_time, stale)
+		# before Redis 7, events trimmed from the stream come back without
+		# fields; acknowledge them so they aren't claimed again
+		trimmed = [event_id for event_id, fields in entries if not fields]
+		if trimmed:
+			self.cache.xack(stream_key, self.__class__.GROUP, *trimmed)
+		return [(event_id, fields) for event_id, fields in entries if fields]
+
+	def fold(self, entries):
+		'''
+		Apply a batch of events to the summaries and acknowledge them, together
+		in one transaction (pipelined without one on a cluster)
+		'''
+		cls = self.__class__
+		calls = collections.defaultdict(dict)
+		call_counts = collections.defaultdict(collections.Counter)
+		destination_counts = collections.defaultdict(collections.Counter)
+
+		for event_id, fields in entries:
+			event, sid = fields['event'], fields['sid']
+			at = datetime.datetime.utcfromtimestamp(int(event_id.split('-')[0]) / 1000.0).isoformat()
+			for summary_field, event_field in cls.SUMMARY_FIELDS.get(event, {}).items():
+				value = at if event_field is None else fields.get(event_field)
+				if value is not None:
+					calls[sid][summary_field] = value
+			counts = collections.Counter()
+			if event in cls.COUNTERS:
+				counts[cls.COUNTERS[event]] += 1
+			if event == 'cost':
+				counts['cost_cents'] += int(fields['cost_cents'])
+			call_counts[sid].update(counts)
+			if fields.get('to'):
+				destination_counts[fields['to']].update(counts)
+
+		pipe = self.cache.pipeline(transaction=not self.cluster)
+		for sid in set(calls) | set(call_counts):
+			key = self.get_call_summary_key(sid)
+			if calls[sid]:
+				pipe.hset(key, mapping=calls[sid])
+			for counter, value in call_counts[sid].items():
+				pipe.hincrby(key, counter, value)
+			pipe.expire(key, self.summary_ttl)
+		for destination, counts in destination_counts.items():
+			key = self.get_destination_summary_key(destination)
+			for counter, value in counts.items():
+				pipe.hincrby(key, counter, value)
+			pipe.sadd(cls.KEY_DESTINATIONS, destination)
+		pipe.xack(self.get_stream_key(), cls.GROUP, *[event_id for event_id, fields in entries])
+		pipe.execute()
+
+	def get_call_summary(self, inbound_sid):
+		'''
+		Return a call's summary as folded so far
+		'''
+		return self.cache.hgetall(self.get_call_summary_key(inbound_sid))
+
+	def get_destination_summaries(self):
+		'''
+		Return every destination's totals, by destination number
+		'''
+		destinations = sorted(self.cache.smembers(self.__class__.KEY_DESTINATIONS))
+		pipe = self.cache.pipeline(transaction=False)
+		for destination in destinations:
+			pipe.hgetall(self.get_destination_summary_key(destination))
+		return dict(zip(destinations, pipe.execute()))
@@ -1,6 +1,12 @@
 import utils
 import json
 import os.path
+import sys
+import time
+import argparse
+import mmap
+import struct
+import bisect
 
 # US Census data often uses FIPS codes to identify states instead of the usual
 # abbreviations. Need to map from the codes to the abbreviations
@@ -22,9 +28,34 @@ ZCTA_TO_CD_FILE_CURRENT = 'http://www2.census.gov/geo/relfiles/cdsld13/natl/natl
 # Path to local cache of ZIP data so we don't always have to regenerate this
 LOCAL_ZIPS_FILE = 'zip_codes.json'
 
+# Path to compact binary copy of the ZIP data. Workers map this file read-only
+# so every process shares one page-cached copy and nothing is parsed at startup.
+LOCAL_ZIPS_BINARY_FILE = 'zip_codes.bin'
+
+# Binary layout: header (magic, record count), then an offset index giving the
+# first record number for each 3-digit ZIP prefix (plus an end sentinel), then
+# fixed-width records of packed ZIP, state abbreviation and district, sorted by ZIP.
+ZIPS_BINARY_MAGIC = b'ZCD1'
+ZIPS_BINARY_HEADER = struct.Struct('<4sI')
+ZIPS_BINARY_INDEX = struct.Struct('<1001I')
+ZIPS_BINARY_RECORD = struct.Struct('<I2s2s')
+ZIPS_BINARY_INDEX_DIGITS = 3
+
+# Directory of local copies of the Census files (named as in their URLs) to read
+# instead of downloading them, e.g. for builds without network access
+source_dir = None
+
 state_fips_codes = None
 zips = None
 
+def get_source(url):
+  '''
+  Get the URL or local path to read a Census file from
+  '''
+  if source_dir:
+    return os.path.join(source_dir, url.rsplit('/', 1)[-1])
+  return url
+
 def get_state_fips_codes():
   '''
   Get listing of state FIPS codes
@@ -32,7 +63,7 @@ def get_state_fips_codes():
   global state_fips_codes
 
   if not state_fips_codes:
-    state_fips_codes = utils.csv_url_to_dicts(STATE_FIPS_CODE_FILE, delimiter='|')
+    state_fips_codes = utils.csv_url_to_dicts(get_source(STATE_FIPS_CODE_FILE), delimiter='|')
 
   return state_fips_codes
 
@@ -51,7 +82,100 @@ def get_state_name_map():
   return {code['STUSAB']: code['STATE_NAME'] for code in state_fips_codes}
 
 
-def get_zip_state_cd_tuples():
+class ZipRecords(object):
+  '''
+  Read-only sequence of Zip/State/Congressional District objects backed by a
+  memory-mapped binary file written by write_zip_binary_file.
+  '''
+
+  def __init__(self, path):
+    with open(path, 'rb') as binary_file:
+      self.buffer = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, self.count = ZIPS_BINARY_HEADER.unpack_from(self.buffer, 0)
+    if magic != ZIPS_BINARY_MAGIC:
+      raise ValueError('{0} is not a ZIP data file'.format(path))
+
+    self.index = ZIPS_BINARY_INDEX.unpack_from(self.buffer, ZIPS_BINARY_HEADER.size)
+    self.records_offset = ZIPS_BINARY_HEADER.size + ZIPS_BINARY_INDEX.size
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    for i in range(self.count):
+      yield self.get_record(i)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.count
+    if i < 0 or i >= self.count:
+      raise IndexError('ZIP record index out of range')
+    return self.get_record(i)
+
+  def get_packed_zip(self, i):
+    '''
+    Get the integer ZIP code of a record without decoding the rest of it
+    '''
+    return ZIPS_BINARY_RECORD.unpack_from(self.buffer, self.records_offset + i * ZIPS_BINARY_RECORD.size)[0]
+
+  def get_record(self, i):
+    '''
+    Decode a single record into the same dict shape as the JSON cache
+    '''
+    zip_code, state, cd = ZIPS_BINARY_RECORD.unpack_from(self.buffer, self.records_offset + i * ZIPS_BINARY_RECORD.size)
+    return {'zip': '{0:05d}'.format(zip_code), 'state': state.decode('ascii'), 'cd': cd.decode('ascii')}
+
+  def lower_bound(self, packed_zip, lo, hi):
+    '''
+    Find the first record number in [lo, hi) whose ZIP is not less than packed_zip
+    '''
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.get_packed_zip(mid) < packed_zip:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def prefix_range(self, prefix):
+    '''
+    Get the (start, end) record numbers of all ZIPs starting with prefix
+    '''
+    if len(prefix) > 5 or not prefix.isdigit():
+      return (0, self.count) if prefix == '' else (0, 0)
+
+    scale = 10 ** (5 - len(prefix))
+    low, high = int(prefix) * scale, (int(prefix) + 1) * scale
+
+    # narrow the search to the 3-digit buckets covering the prefix
+    bucket_scale = 10 ** (5 - ZIPS_BINARY_INDEX_DIGITS)
+    lo = self.index[low // bucket_scale]
+    hi = self.index[(high - 1) // bucket_scale + 1]
+
+    return (self.lower_bound(low, lo, hi), self.lower_bound(high, lo, hi))
+
+def write_zip_binary_file(zip_tuples, path=LOCAL_ZIPS_BINARY_FILE):
+  '''
+  Write Zip/State/Congressional District objects to the compact binary format
+  '''
+  records = sorted((int(z['zip']), z['state'], z['cd']) for z in zip_tuples)
+
+  index = []
+  bucket_scale = 10 ** (5 - ZIPS_BINARY_INDEX_DIGITS)
+  for bucket in range(10 ** ZIPS_BINARY_INDEX_DIGITS + 1):
+    index.append(bisect.bisect_left(records, (bucket * bucket_scale,)))
+
+  # write to a temporary file and rename so readers never map a partial file
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as binary_file:
+    binary_file.write(ZIPS_BINARY_HEADER.pack(ZIPS_BINARY_MAGIC, len(records)))
+    binary_file.write(ZIPS_BINARY_INDEX.pack(*index))
+    for zip_code, state, cd in records:
+      binary_file.write(ZIPS_BINARY_RECORD.pack(zip_code, state.encode('ascii'), cd.encode('ascii')))
+  os.rename(tmp_path, path)
+
+def get_zip_state_cd_tuples(use_binary=True):
   '''
   Get a list of Zip/State/Congressional District objects
   '''
@@ -61,31 +185,99 @@ def get_zip_state_cd_tuples():
   if zips:
     return zips
 
-  # use the local cache if it's present
+  # use the memory-mapped binary cache if it's present
+  if use_binary and os.path.isfile(LOCAL_ZIPS_BINARY_FILE):
+    zips = ZipRecords(LOCAL_ZIPS_BINARY_FILE)
+    return zips
+
+  # fall back to the JSON cache if it's present
   if os.path.isfile(LOCAL_ZIPS_FILE):
     zips_file = open(LOCAL_ZIPS_FILE, 'r') 
     zips = json.loads(zips_file.read())
     return zips
 
   # load the data from the US Census if all else fails
+  zips = list(iter_zip_state_cd_tuples())
+  return zips
+
+def timed_stage(name, rows, stats):
+  '''
+  Pass rows through, appending the stage's row count and elapsed time to stats
+  once it's exhausted
+  '''
+  start = time.time()
+  count = 0
+  for row in rows:
+    count += 1
+    yield row
+  stats.append((name, count, time.time() - start))
+
+def iter_zip_state_cd_tuples(stats=None):
+  '''
+  Stream Zip/State/Congressional District objects from the US Census files
+  '''
+  if stats is None:
+    stats = []
+
+  start = time.time()
   state_fips_map = get_fips_to_state_map()
-  current_zctas = utils.csv_url_to_dicts(ZCTA_TO_CD_FILE_CURRENT, ignore_first=1)
-  current_zcta_zips = [z['ZCTA'] for z in current_zctas]
+  stats.append(('state FIPS codes', len(state_fips_map), time.time() - start))
+
+  current_zcta_zips = set()
+  seen = set()
+
+  # first portion of the stream are the tuples from the current ZCTA file
+  for zcta in timed_stage('current ZCTA file', utils.iter_csv_dicts(get_source(ZCTA_TO_CD_FILE_CURRENT), ignore_first=1), stats):
+    current_zcta_zips.add(zcta['ZCTA'])
+    z = (zcta['ZCTA'], state_fips_map[zcta['State']], zcta['Congressional District'].zfill(2))
+    if z not in seen:
+      seen.add(z)
+      yield {'zip': z[0], 'state': z[1], 'cd': z[2]}
 
-  # first portion of the list are the tuples from the current ZCTA file
   # second portion are the tuples from states with only a single CD from the old ZCTA file
-  zips = [{
-    'zip': zcta['ZCTA'],
-    'state': state_fips_map[zcta['State']],
-    'cd': zcta['Congressional District'].zfill(2)
-  } for zcta in current_zctas] + [{
-    'zip': zcta['ZCTA5'],
-    'state': state_fips_map[zcta['STATE']],
-    'cd': '00'
-  } for zcta in utils.csv_url_to_dicts(ZCTA_TO_CD_FILE_ALL)
-  if zcta['ZCTA5'] not in current_zcta_zips]
+  for zcta in timed_stage('all ZCTA file', utils.iter_csv_dicts(get_source(ZCTA_TO_CD_FILE_ALL)), stats):
+    if zcta['ZCTA5'] in current_zcta_zips:
+      continue
+    z = (zcta['ZCTA5'], state_fips_map[zcta['STATE']], '00')
+    if z not in seen:
+      seen.add(z)
+      yield {'zip': z[0], 'state': z[1], 'cd': z[2]}
 
-  return zips
+def write_zip_json_file(zip_tuples, output):
+  '''
+  Write Zip/State/Congressional District objects to a JSON list one at a time
+  '''
+  output.write('[')
+  for i, z in enumerate(zip_tuples):
+    output.write('\n  ' if i == 0 else ',\n  ')
+    output.write(json.dumps(z, sort_keys=True))
+  output.write('\n]\n')
 
 if __name__ == "__main__":
-  print(json.dumps(get_zip_state_cd_tuples(), indent=2))
+  parser = argparse.ArgumentParser(description='Build the ZIP code data cache from US Census files.')
+  parser.add_argument('--source-dir', help='read Census files from this directory instead of downloading them')
+  parser.add_argument('--output', default='-', help='path to write the JSON cache to (default: stdout)')
+  parser.add_argument('--binary', nargs='?', const=LOCAL_ZIPS_BINARY_FILE,
+    help='write the binary cache instead (default path: {0}), built from the JSON cache if present'.format(LOCAL_ZIPS_BINARY_FILE))
+  args = parser.parse_args()
+
+  source_dir = args.source_dir
+  stats = []
+
+  if args.binary:
+    if os.path.isfile(LOCAL_ZIPS_FILE):
+      zip_tuples = timed_stage('JSON cache', get_zip_state_cd_tuples(use_binary=False), stats)
+    else:
+      zip_tuples = iter_zip_state_cd_tuples(stats)
+    write_zip_binary_file(timed_stage('binary output', zip_tuples, stats), args.binary)
+  elif args.output == '-':
+    write_zip_json_file(timed_stage('JSON output', iter_zip_state_cd_tuples(stats), stats), sys.stdout)
+  else:
+    # write to a temporary file and rename so a failed build never clobbers the cache
+    tmp_path = args.output + '.tmp'
+    with open(tmp_path, 'w') as output:
+      write_zip_json_file(timed_stage('JSON output', iter_zip_state_cd_tuples(stats), stats), output)
+    os.rename(tmp_path, args.output)
+
+  for name, count, elapsed in stats:
+    sys.stderr.write('{0}: {1} rows in {2:.2f}s\n'.format(name, count, elapsed))
@@ -0,0 +1,40 @@
+import json
+import redisclient
+
+class JobQueue(object):
+
+	KEY_QUEUE = 'jobs:{0}'
+
+	def __init__(self, conn_args={}, name='twilio'):
+		self.conn_args = conn_args
+		self.name = name
+
+		self.cache = redisclient.connect(self.conn_args)
+
+	def get_queue_key(self):
+		'''
+		Return the key for the queue's job list
+		'''
+		return self.__class__.KEY_QUEUE.format(self.name)
+
+	def enqueue(self, job, **kwargs):
+		'''
+		Add a named job and its keyword arguments to the queue
+		'''
+		key = self.get_queue_key()
+		self.cache.lpush(key, json.dumps({'job': job, 'kwargs': kwargs}))
+
+	def dequeue(self, timeout=0):
+		'''
+		Block until a job is available and return its name and keyword
+		arguments, or None if the timeout (in seconds) expires first
+		'''
+		key = self.get_queue_key()
+		item = self.cache.brpop(key, timeout=timeout)
+		if item is None:
+			return None
+		payload = json.loads(item[1])
+		return payload['job'], payload['kwargs']
+
+	def __len__(self):
+		return self.cache.llen(self.get_queue_key())
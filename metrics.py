@@ -0,0 +1,198 @@
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import threading
+import time
+import redisclient
+
+# Latency histograms and counters for the hot paths. Each process aggregates
+# observations in memory and periodically adds them to Redis hashes, so the
+# /metrics export covers every Gunicorn worker and the background worker.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics(object):
+
+	KEY_METRIC = 'metrics:{0}'
+	KEY_TYPES = 'metrics:types'
+
+	def __init__(self, conn_args=None, flush_interval=5, buckets=DEFAULT_BUCKETS):
+		self.flush_interval = flush_interval
+		self.buckets = tuple(buckets)
+		self.lock = threading.Lock()
+		self.pending = collections.defaultdict(float)
+		self.types = {}
+		self.last_flush = time.time()
+		self.cache = None
+		if conn_args is not None:
+			self.configure(conn_args)
+
+	def configure(self, conn_args={}, flush_interval=None):
+		'''
+		Start sending observations to Redis. Until then they're kept in memory.
+		'''
+		self.cache = redisclient.connect(conn_args)
+		if flush_interval is not None:
+			self.flush_interval = flush_interval
+
+	def get_metric_key(self, name):
+		'''
+		Return the key for a metric's hash of aggregated values
+		'''
+		return self.__class__.KEY_METRIC.format(name)
+
+	def format_labels(self, labels):
+		return ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+	def observe(self, name, seconds, **labels):
+		'''
+		Record a duration in a histogram
+		'''
+		label_str = self.format_labels(labels)
+		bucket = bisect.bisect_left(self.buckets, seconds)
+		le = str(self.buckets[bucket]) if bucket < len(self.buckets) else '+Inf'
+		with self.lock:
+			self.types[name] = 'histogram'
+			self.pending[(name, 'bucket|{0}|{1}'.format(le, label_str))] += 1
+			self.pending[(name, 'sum|' + label_str)] += seconds
+			self.pending[(name, 'count|' + label_str)] += 1
+		self.maybe_flush()
+
+	def increment(self, name, value=1, **labels):
+		'''
+		Add to a counter
+		'''
+		with self.lock:
+			self.types[name] = 'counter'
+			self.pending[(name, 'value|' + self.format_labels(labels))] += value
+		self.maybe_flush()
+
+	@contextlib.contextmanager
+	def timer(self, name, **labels):
+		'''
+		Time the enclosed block into a histogram, counting errors separately
+		'''
+		start = time.time()
+		try:
+			yield
+		except Exception:
+			self.increment(name + '_errors_total', **labels)
+			raise
+		finally:
+			self.observe(name, time.time() - start, **labels)
+
+	def timed(self, name, **labels):
+		'''
+		Decorator form of timer
+		'''
+		def decorator(func):
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				with self.timer(name, **labels):
+					return func(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def timed_methods(self, name, label='method', exclude=()):
+		'''
+		Class decorator timing every public method into a histogram labeled
+		with the method name. Exclude context managers and generators, as only
+		creating them would be timed.
+		'''
+		def decorator(cls):
+			for attr, value in list(vars(cls).items()):
+				if attr.startswith('_') or attr in exclude or not callable(value):
+					continue
+				setattr(cls, attr, self.timed(name, **{label: attr})(value))
+			return cls
+		return decorator
+
+	def maybe_flush(self):
+		if self.cache is not None and time.time() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		'''
+		Add everything observed since the last flush to the totals in Redis
+		'''
+		if self.cache is None:
+			return
+		with self.lock:
+			pending, self.pending = self.pending, collections.defaultdict(float)
+			types = dict(self.types)
+			self.last_flush = time.time()
+		if not pending:
+			return
+		pipe = self.cache.pipeline(transaction=False)
+		pipe.hmset(self.__class__.KEY_TYPES, types)
+		for (name, field), value in pending.items():
+			if field.startswith('sum|'):
+				pipe.hincrbyfloat(self.get_metric_key(name), field, value)
+			else:
+				pipe.hincrby(self.get_metric_key(name), field, int(value))
+		pipe.execute()
+
+	def render(self):
+		'''
+		Return aggregated metrics from every process in the Prometheus text format
+		'''
+		self.flush()
+		types = self.cache.hgetall(self.__class__.KEY_TYPES)
+		pipe = self.cache.pipeline(transaction=False)
+		names = sorted(types.keys())
+		for name in names:
+			pipe.hgetall(self.get_metric_key(name))
+		lines = []
+		for name, fields in zip(names, pipe.execute()):
+			lines.append('# TYPE {0} {1}'.format(name, types[name]))
+			if types[name] == 'counter':
+				for field, value in sorted(fields.items()):
+					lines.append(self.format_sample(name, field.split('|', 1)[1], value))
+				continue
+			series = collections.defaultdict(dict)
+			for field, value in fields.items():
+				kind, rest = field.split('|', 1)
+				if kind == 'bucket':
+					le, label_str = rest.split('|', 1)
+					series[label_str][le] = int(value)
+				else:
+					series[rest][kind] = value
+			for label_str, values in sorted(series.items()):
+				cumulative = 0
+				for le in [str(b) for b in self.buckets] + ['+Inf']:
+					cumulative += values.get(le, 0)
+					le_label = 'le="{0}"'.format(le)
+					lines.append(self.format_sample(name + '_bucket', label_str + ',' + le_label if label_str else le_label, cumulative))
+				lines.append(self.format_sample(name + '_sum', label_str, values.get('sum', 0)))
+				lines.append(self.format_sample(name + '_count', label_str, values.get('count', 0)))
+		return '\n'.join(lines) + '\n'
+
+	def format_sample(self, name, label_str, value):
+		if label_str:
+			return '{0}{{{1}}} {2}'.format(name, label_str, value)
+		return '{0} {1}'.format(name, value)
+
+class TimedProxy(object):
+	'''
+	Wrap an object so every method call on it is timed into a histogram,
+	e.g. for third-party clients that can't be decorated. Exclude methods
+	returning generators, as only creating the generator would be timed.
+	'''
+	def __init__(self, target, metrics, name, label='method', exclude=()):
+		self.target = target
+		self.metrics = metrics
+		self.name = name
+		self.label = label
+		self.exclude = exclude
+
+	def __getattr__(self, attr):
+		value = getattr(self.target, attr)
+		if attr.startswith('_') or attr in self.exclude or not callable(value):
+			return value
+		return self.metrics.timed(self.name, **{self.label: attr})(value)
+
+# shared registry for the process; call registry.configure() to send to Redis
+registry = Metrics()
+atexit.register(registry.flush)
@@ -0,0 +1,102 @@
+import time
+import redisclient
+
+class RateLimiter(object):
+	'''
+	Token bucket shared through Redis by every process on every node, e.g. to
+	keep outbound calls under the Twilio account's calls-per-second limit.
+	Requests over the limit reserve a future token and wait for it, unless
+	the wait would be longer than allowed, in which case they're rejected
+	and told how long until a token is free.
+	'''
+
+	KEY_BUCKET = 'ratelimit:{0}:bucket'
+	KEY_COUNTERS = 'ratelimit:{0}:counters'
+
+	COUNTERS = ['admitted', 'delayed', 'rejected']
+
+	# Take a token, refilling the bucket for the time since it was last used.
+	# Going into debt reserves a future token. Return seconds to wait for the
+	# token, or if that would exceed the maximum wait, minus the wait (no
+	# token is taken).
+	# Uses the Redis clock so all nodes agree on the time.
+	# KEYS: bucket; ARGV: tokens per second, bucket size, maximum wait
+	SCRIPT_TAKE = '''
+		local rate = tonumber(ARGV[1])
+		local burst = tonumber(ARGV[2])
+		local time = redis.call('TIME')
+		local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+		local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+		local tokens = tonumber(bucket[1]) or burst
+		local updated_at = tonumber(bucket[2]) or now
+		tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+		local wait = math.max(0, (1 - tokens) / rate)
+		if wait > tonumber(ARGV[3]) then
+			return tostring(-wait)
+		end
+		tokens = tokens - 1
+		redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+		-- keep the bucket until it has refilled, debt included
+		redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+		return tostring(wait)
+	'''
+
+	def __init__(self, conn_args={}, name='calls', rate=1, burst=1, max_wait=10):
+		self.conn_args = conn_args
+		self.name = name
+		self.rate = rate
+		self.burst = burst
+		self.max_wait = max_wait
+
+		self.cache = redisclient.connect(self.conn_args)
+		self.take_script = self.cache.register_script(self.__class__.SCRIPT_TAKE)
+
+	def get_bucket_key(self):
+		'''
+		Return the key for the token bucket
+		'''
+		return self.__class__.KEY_BUCKET.format(self.name)
+
+	def get_counters_key(self):
+		'''
+		Return the key for the admitted, delayed and rejected counters
+		'''
+		return self.__class__.KEY_COUNTERS.format(self.name)
+
+	def reserve(self, max_wait=None):
+		'''
+		Take a token without waiting for it, and return the seconds until
+		it's due. If that's longer than max_wait seconds (by default, the
+		limiter's maximum wait), take nothing and return minus the wait, so
+		the caller can try again once it has passed.
+		'''
+		if max_wait is None:
+			max_wait = self.max_wait
+		wait = float(self.take_script(keys=[self.get_bucket_key()], args=[self.rate, self.burst, max_wait]))
+		if wait < 0:
+			self.cache.hincrby(self.get_counters_key(), 'rejected', 1)
+			return wait
+		if wait > 0:
+			self.cache.hincrby(self.get_counters_key(), 'delayed', 1)
+		self.cache.hincrby(self.get_counters_key(), 'admitted', 1)
+		return wait
+
+	def acquire(self, max_wait=None):
+		'''
+		Wait until the request is within the rate limit and return True, or
+		return False straight away if that would take longer than max_wait
+		seconds (by default, the limiter's maximum wait).
+		'''
+		wait = self.reserve(max_wait)
+		if wait < 0:
+			return False
+		time.sleep(wait)
+		return True
+
+	def get_counters(self):
+		'''
+		Return counts of admitted, delayed and rejected requests. Delayed
+		requests are also counted as admitted.
+		'''
+		counters = self.cache.hgetall(self.get_counters_key())
+		return dict((name, int(counters.get(name, 0))) for name in self.__class__.COUNTERS)
@@ -1,10 +1,22 @@
-from flask import Flask, request, redirect, url_for, render_template, jsonify
+from flask import Flask, request, redirect, url_for, render_template, jsonify, g
 import datetime
+import time
 import json
 import math
+import os
+import threading
 import twilio
 import twilio.twiml
 from callstatemanager import CallStateManager
+from jobqueue import JobQueue
+from redialscheduler import RedialScheduler
+from ratelimiter import RateLimiter
+from twimlcache import TwimlCache
+from callercache import CallerCache
+from eventlog import EventLog
+import metrics
+import redisclient
+from twilio_stub import StubTwilioRestClient
 import congress
 
 app = Flask(__name__)
@@ -12,45 +24,163 @@ app.config.from_object('config')
 
 TWILIO_VOICE = app.config['TWILIO_VOICE']
 
-TRC =twilio.rest.TwilioRestClient(**app.config['TWILIO_REST_CLIENT_KWARGS'])
-CallState = CallStateManager(conn_args=app.config['REDIS_CLIENT_KWARGS'], ttl=app.config['REDIS_TTL'])
-
-def start_outbound_call(response, inbound_sid, from_, to, label):
+Metrics = metrics.registry
+Metrics.configure(app.config['REDIS_CLIENT_KWARGS'], flush_interval=app.config.get('METRICS_FLUSH_INTERVAL', 5))
+
+TwilioHttp = None
+if app.config.get('TWILIO_STUB'):
+	TRC = StubTwilioRestClient(**app.config['TWILIO_REST_CLIENT_KWARGS'])
+else:
+	import twiliohttp
+	# reuse keep-alive connections to the API instead of a new one per request
+	TwilioHttp = twiliohttp.install(**app.config.get('TWILIO_HTTP_POOL_KWARGS', {}))
+	TRC =twilio.rest.TwilioRestClient(**app.config['TWILIO_REST_CLIENT_KWARGS'])
+# iter's pages are timed where they're read (see worker.reap_orphaned_calls)
+TRC.calls = metrics.TimedProxy(TRC.calls, Metrics, 'redialer_twilio_seconds', exclude=('iter',))
+Callers = CallerCache(conn_args=app.config['REDIS_CLIENT_KWARGS'], **app.config.get('CALLER_CACHE_KWARGS', {}))
+CallState = CallStateManager(conn_args=app.config['REDIS_CLIENT_KWARGS'], ttl=app.config['REDIS_TTL'], caller_ttl=app.config.get('REDIS_CALLER_TTL'), hash_tags=app.config.get('REDIS_HASH_TAGS', False), caller_cache=Callers)
+Jobs = JobQueue(conn_args=app.config['REDIS_CLIENT_KWARGS'])
+Events = EventLog(conn_args=app.config['REDIS_CLIENT_KWARGS'], **app.config.get('EVENT_LOG_KWARGS', {}))
+Scheduler = RedialScheduler(conn_args=app.config['REDIS_CLIENT_KWARGS'], hash_tags=CallState.hash_tags, status_key=CallState.get_status_key('{0}'), **app.config.get('REDIAL_SCHEDULER_KWARGS', {}))
+Twiml = TwimlCache(max_size=app.config.get('TWIML_CACHE_SIZE', 1024))
+congress.reload_listeners.append(Twiml.clear)
+
+# load the roster and ZIP index now, before any fork, rather than during a call
+congress.get_roster()
+OutboundRate = RateLimiter(conn_args=app.config['REDIS_CLIENT_KWARGS'], name='outbound_calls', **app.config.get('OUTBOUND_RATE_LIMIT_KWARGS', {}))
+
+def start_outbound_call(response, inbound_sid, from_, destinations, label):
 	'''
-	Initiate an outbound call wrapped in a TwiML response. Park the inbound
-	call in a conference while waiting for the outbound call to connect. 
+	Initiate outbound calls to one or more destinations at once, wrapped in a
+	TwiML response. Park the inbound call in a conference while waiting for
+	an outbound call to connect; the first to answer is bridged into it.
 	'''
-	try:
-		attempt_outbound_call(inbound_sid, from_, to)
+	# written before any leg is placed, so an early answer finds every leg
+	with CallState.batch() as state:
+		state.set_data(inbound_sid, started_at=datetime.datetime.utcnow().isoformat(), destinations=','.join(destinations))
+		for to in destinations:
+			Events.append('member_selected', inbound_sid, client=state.cache, to=to)
+
+	# each leg's attempt is written as soon as it's placed, before the next
+	# leg is, so its status callbacks always find the caller
+	placed = 0
+	for to in destinations:
+		try:
+			attempt_outbound_call(inbound_sid, from_, to)
+			placed += 1
+		except twilio.TwilioRestException as e:
+			app.logger.error(e)
+
+	if placed:
 		response.say("Connecting you to {0}.".format(label), voice=TWILIO_VOICE)
 		with response.dial() as d:
 			d.conference(inbound_sid, endConferenceOnExit=True, beep=True, waitUrl=url_for('wait_for_outbound'))
-	except twilio.TwilioRestException as e:
-		app.logger.error(e)
+	else:
 		response.say("Sorry, an error occurred while connecting your call. Please try again.", voice=TWILIO_VOICE)
 		response.redirect(url_for('search_by_name'))
 
-	CallState.set_data(inbound_sid, started_at=datetime.datetime.utcnow().isoformat())
+def get_destinations(call_data):
+	'''
+	Return the numbers being dialed for an inbound call
+	'''
+	if 'destinations' in call_data:
+		return call_data['destinations'].split(',')
+	return [call_data['to']] if 'to' in call_data else []
 
 
-def attempt_outbound_call(inbound_sid, from_, to):
+def attempt_outbound_call(inbound_sid, from_, to, state=CallState, delay=0):
+	'''
+	Queue an outbound call attempt with the redial scheduler for its destination.
+	Place it right away if it's due, no earlier caller is waiting, the
+	destination has a free attempt slot and the rate limit has a token free;
+	otherwise the worker places it later.
+	'''
+	Scheduler.schedule(to, inbound_sid, delay, from_=from_, url_root=request.url_root)
+	if delay <= 0 and Scheduler.claim(to, inbound_sid):
+		# don't hold up the webhook waiting on the rate limit
+		place_outbound_call(inbound_sid, from_, to, state=state, block=False)
+
+def place_outbound_call(inbound_sid, from_, to, state=CallState, max_wait=None, block=True, rate_reserved=False):
 	'''
 	Create an outbound call via Twilio API. Capture outbound number with inbound SID.
-	Link inbound SID to outbound SID.
+	Link inbound SID to outbound SID. Reserve a token from the account-wide
+	outbound rate limit and wait for it, or with block=False, hand the call
+	to the redial scheduler for when the token is due, so each leg of a
+	multi-office dial keeps its own place under the limit. Calls the limit
+	can't admit within max_wait seconds are rescheduled for when it will.
+	rate_reserved is set for calls whose token was reserved earlier.
 	'''
 
 	app.logger.info('from %s', from_)
-	outbound_call = TRC.calls.create(
-		url=url_for('connect_outbound', _external=True),
-		#from_=app.config['TWILIO_DEFAULT_FROM'] if from_ == '' else from_,
-		from_=app.config['TWILIO_DEFAULT_FROM'],
-		to=to,
-		timeout=600, # use Twilio's maximum timeout because some calls can ring for quite some time
-		status_callback=url_for('ping_outbound', _external=True),
-		status_callback_method='POST',
-		status_events=['initiated', 'ringing', 'answered', 'completed']
-	)
-	CallState.log_new_attempt(inbound_sid, outbound_call)
+	if not rate_reserved:
+		wait = OutboundRate.reserve(max_wait=max_wait)
+		if wait < 0:
+			app.logger.info('rate limited, rescheduling %s in %.1fs', to, -wait)
+			Scheduler.schedule(to, inbound_sid, -wait, from_=from_, url_root=request.url_root)
+			return
+		if wait > 0 and not block:
+			app.logger.info('rate limited, placing %s in %.1fs', to, wait)
+			Scheduler.schedule(to, inbound_sid, wait, from_=from_, url_root=request.url_root, rate_reserved=True)
+			return
+		time.sleep(wait)
+	try:
+		outbound_call = TRC.calls.create(
+			url=url_for('connect_outbound', _external=True),
+			#from_=app.config['TWILIO_DEFAULT_FROM'] if from_ == '' else from_,
+			from_=app.config['TWILIO_DEFAULT_FROM'],
+			to=to,
+			timeout=600, # use Twilio's maximum timeout because some calls can ring for quite some time
+			status_callback=url_for('ping_outbound', _external=True),
+			status_callback_method='POST',
+			status_events=['initiated', 'ringing', 'answered', 'completed']
+		)
+	except Exception:
+		Scheduler.finish(to, inbound_sid)
+		raise
+	with state.batch() as batch:
+		batch.log_new_attempt(inbound_sid, outbound_call)
+		Events.append('attempt', inbound_sid, client=batch.cache, to=to, call_sid=outbound_call.sid)
+
+def enqueue_job(job, **kwargs):
+	'''
+	Queue a Twilio API job for the background worker (see worker.py), along
+	with the URL root it needs to build callback URLs outside this request.
+	'''
+	Jobs.enqueue(job, url_root=request.url_root, **kwargs)
+
+# Append every webhook's form payload and arrival time to this file, as JSON
+# lines, for replay.py to play back
+WEBHOOK_TRACE_FILE = app.config.get('WEBHOOK_TRACE_FILE')
+trace_lock = threading.Lock()
+
+@app.before_request
+def capture_webhook():
+	if not WEBHOOK_TRACE_FILE or request.method != 'POST':
+		return
+	line = json.dumps({'time': time.time(), 'path': request.path, 'form': request.form.to_dict()}, sort_keys=True) + '\n'
+	with trace_lock:
+		# one append per line so workers sharing the file don't interleave
+		with open(WEBHOOK_TRACE_FILE, 'a') as trace_file:
+			trace_file.write(line)
+
+@app.before_request
+def start_roster_refresher():
+	congress.start_refresher(app.config.get('MEMBERS_REFRESH_INTERVAL', 60))
+
+@app.before_request
+def start_request_timer():
+	g.request_started_at = time.time()
+
+@app.teardown_request
+def observe_request_time(exc=None):
+	'''
+	Time every webhook into the route latency histogram
+	'''
+	if request.endpoint in (None, 'export_metrics') or 'request_started_at' not in g:
+		return
+	if exc is not None:
+		Metrics.increment('redialer_webhook_seconds_errors_total', route=request.endpoint)
+	Metrics.observe('redialer_webhook_seconds', time.time() - g.request_started_at, route=request.endpoint)
 
 def zip_pad(zip_code):
 	return " ".join(list(zip_code))
@@ -65,14 +195,25 @@ def greet_caller():
 		'received_at': datetime.datetime.utcnow().isoformat()
 	}
 
-	CallState.set_data(request.form['CallSid'], **call_data)
+	caller_data = CallState.get_caller_data(request.form['From'])
+	with CallState.batch() as state:
+		state.set_data(request.form['CallSid'], **call_data)
+		state.set_status(request.form['CallSid'], 'in-progress')
+		Events.append('received', request.form['CallSid'], client=state.cache, **{'from': request.form['From']})
+
+	zip_code = caller_data.get('zip')
+	return Twiml.get(('greeting', zip_code), lambda: render_greeting(zip_code))
+
+def render_greeting(zip_code=None):
+	'''
+	Render the greeting, offering to reuse the caller's previous ZIP code if known
+	'''
 	response = twilio.twiml.Response()
 	response.say("Hello fellow American!", voice=TWILIO_VOICE)
 
-	caller_data = CallState.get_caller_data(request.form['From'])
-	if caller_data and 'zip' in caller_data:
+	if zip_code:
 		with response.gather(numDigits=1, timeout=1, action=url_for('set_zip_code')) as g:
-			g.say("I see you've called before from zip code {0}. Press star to enter a different zip code.".format(zip_pad(caller_data['zip'])), voice=TWILIO_VOICE)
+			g.say("I see you've called before from zip code {0}. Press star to enter a different zip code.".format(zip_pad(zip_code)), voice=TWILIO_VOICE)
 		response.redirect(url_for('select_member'))
 	else:
 		response.redirect(url_for('set_zip_code'))
@@ -106,7 +247,9 @@ def set_zip_code():
 			response.redirect(url_for('set_zip_code'))
 		else:
 			# set zip and redirect to listing of members
-			CallState.set_caller_data(request.form['From'], zip=zip_code)
+			with CallState.batch() as state:
+				state.set_caller_data(request.form['From'], zip=zip_code)
+				Events.append('zip_set', inbound_sid, client=state.cache, zip=zip_code)
 			response.redirect(url_for('select_member'))
 
 	return str(response)
@@ -119,37 +262,61 @@ def select_member():
 	inbound_sid = request.form['CallSid']
 	caller_data = CallState.get_caller_data(request.form['From'])
 	zip_code = caller_data['zip']
+
+	if 'Digits' not in request.form:
+		# Offer user menu of result options to select from.
+		return Twiml.get(('member_menu', zip_code), lambda: render_member_menu(zip_code))
+
 	results = congress.search_by_zip(zip_code)
 
 	response = twilio.twiml.Response()
 
-	if 'Digits' not in request.form:
-		# Offer user menu of result options to select from.
-		digits_to_gather = int(math.floor(math.log10(len(results)))+1)
-		response.say("I've found {0} members of Congress for zip code {1}.".format(len(results), zip_pad(zip_code)), voice=TWILIO_VOICE)
-		with response.gather(numDigits=digits_to_gather, timeout=20, action=url_for('select_member')) as g:
-			for i, member in enumerate(results):
-				g.say("Press {0} for {1}.".format(i + 1, member['label']), voice=TWILIO_VOICE)
-			g.say("Or press star to enter a new zip code.", voice=TWILIO_VOICE)
-	else:
-		if request.form['Digits'] in '*#':
-			response.redirect(url_for('set_zip_code'))	
-			return str(response)
+	if request.form['Digits'] in '*#':
+		response.redirect(url_for('set_zip_code'))	
+		return str(response)
+
+	if request.form['Digits'] == '0' and len(results) > 1:
+		start_outbound_call(
+			response=response,
+			inbound_sid=request.form['CallSid'],
+			from_=request.form['To'],
+			destinations=[member['phone'] for member in results],
+			label='whichever of your members of Congress answers first'
+		)
+		return str(response)
 
-		try:
-			selection_index = int(request.form['Digits']) - 1
-
-			member = results[selection_index]
-			start_outbound_call(
-				response=response,
-				inbound_sid=request.form['CallSid'],
-				from_=request.form['To'],
-				to=member['phone'],
-				label=member['label']
-			)
-		except IndexError:
-			response.say("Sorry, your entry doesn't match any of the available options. Let's try again.", voice=TWILIO_VOICE)
-			response.redirect(url_for('select_member'))
+	try:
+		selection_index = int(request.form['Digits']) - 1
+
+		member = results[selection_index]
+		start_outbound_call(
+			response=response,
+			inbound_sid=request.form['CallSid'],
+			from_=request.form['To'],
+			destinations=[member['phone']],
+			label=member['label']
+		)
+	except IndexError:
+		response.say("Sorry, your entry doesn't match any of the available options. Let's try again.", voice=TWILIO_VOICE)
+		response.redirect(url_for('select_member'))
+
+	return str(response)
+
+def render_member_menu(zip_code):
+	'''
+	Render the menu of members of Congress for a ZIP code
+	'''
+	results = congress.search_by_zip(zip_code)
+	response = twilio.twiml.Response()
+
+	digits_to_gather = int(math.floor(math.log10(len(results)))+1)
+	response.say("I've found {0} members of Congress for zip code {1}.".format(len(results), zip_pad(zip_code)), voice=TWILIO_VOICE)
+	with response.gather(numDigits=digits_to_gather, timeout=20, action=url_for('select_member')) as g:
+		for i, member in enumerate(results):
+			g.say("Press {0} for {1}.".format(i + 1, member['label']), voice=TWILIO_VOICE)
+		if len(results) > 1:
+			g.say("Press 0 to call all of them and talk to whoever answers first.", voice=TWILIO_VOICE)
+		g.say("Or press star to enter a new zip code.", voice=TWILIO_VOICE)
 
 	return str(response)
 
@@ -157,12 +324,30 @@ def select_member():
 def connect_outbound():
 	'''
 	Bridge an outbound call to the inbound call by joining the inbound call's conference
-	when the outbound call successfully connects.
+	when the outbound call successfully connects. If several offices were dialed,
+	only the first to answer joins: the others are hung up, along with any
+	redials still waiting.
 	'''
 	outbound_sid = request.form['CallSid']
 	inbound_sid = CallState.get_origin(outbound_sid)
-	CallState.set_data(inbound_sid, connected_at=datetime.datetime.utcnow().isoformat())
 	response = twilio.twiml.Response()
+
+	if not inbound_sid or not CallState.claim_bridge(inbound_sid, outbound_sid):
+		app.logger.info('%s answered after another office, hanging up', request.form['To'])
+		response.hangup()
+		return str(response)
+
+	context = CallState.get_context(inbound_sid=inbound_sid)
+	with CallState.batch() as state:
+		state.set_data(inbound_sid, connected_at=datetime.datetime.utcnow().isoformat(), to=request.form['To'])
+		Events.append('connected', inbound_sid, client=state.cache, to=request.form['To'])
+	for to in get_destinations(context['data']):
+		if to != request.form['To']:
+			Scheduler.finish(to, inbound_sid)
+	for attempt_sid in CallState.get_active_attempts(inbound_sid):
+		if attempt_sid != outbound_sid:
+			enqueue_job('hang_up_outbound', outbound_sid=attempt_sid)
+
 	with response.dial() as d:
 		d.conference(inbound_sid, endConferenceOnExit=True, beep=True, waitUrl='')
 	return str(response)
@@ -171,30 +356,46 @@ def connect_outbound():
 @app.route("/outbound/ping", methods=['POST'])
 def ping_outbound():
 	'''
-	Check status of outbound call from Twilio webhook.
-	Retry outbound call if previous attempt failed,
-	but only if originating call is still connected.
+	Record status of outbound call from Twilio webhook.
+	Schedule a retry of the outbound call after a backoff if previous
+	attempt failed, but only if originating call is still connected.
+	Queue a cost lookup if it completed. Redelivered and late callbacks are
+	ignored, so each attempt is retried and priced at most once.
 	'''
 	app.logger.info('status %s', request.form['CallStatus'])
 
 	outbound_sid = request.form['CallSid']
-	inbound_sid = CallState.get_origin(outbound_sid)
+	if not CallState.record_callback(outbound_sid, request.form['CallStatus'], request.form.get('SequenceNumber')):
+		Metrics.increment('redialer_duplicate_callbacks_total', route='ping_outbound')
+		return ('', 204)
+	context = CallState.get_context(outbound_sid=outbound_sid)
+	inbound_sid = context['origin']
 	retry=False
 
+	if not inbound_sid:
+		# e.g. a leg whose origin expired, or one replayed from a trace
+		app.logger.info('no inbound call for %s', outbound_sid)
+		return ('', 204)
+
 	if request.form['CallStatus'] in ["canceled", "busy", "no-answer"]:
-		inbound_call = TRC.calls.get(inbound_sid)
-		retry = (inbound_call.status == 'in-progress')
+		Events.append('busy' if request.form['CallStatus'] == 'busy' else 'no_answer', inbound_sid, to=request.form['To'], call_sid=outbound_sid)
+		# once another office has answered, stop redialing the rest
+		retry = (context['status'] == 'in-progress') and not CallState.get_bridge(inbound_sid)
 	elif request.form['CallStatus'] in ['completed']:
-		outbound_call = TRC.calls.get(outbound_sid)
-		CallState.add_cost(inbound_sid, outbound_call.price)
+		enqueue_job('capture_cost', inbound_sid=inbound_sid, call_sid=outbound_sid)
 
 	if retry:
-		app.logger.info('retrying %s', request.form['To'])
-		attempt_outbound_call(
-			inbound_sid=inbound_sid,
+		# attempts are counted across every office dialed at once
+		destinations = max(1, len(get_destinations(context['data'])))
+		delay = Scheduler.get_backoff(-(-int(context['data'].get('attempts', 1)) // destinations))
+		app.logger.info('retrying %s in %.1fs', request.form['To'], delay)
+		Scheduler.schedule(request.form['To'], inbound_sid, delay,
 			from_=request.form['From'],
-			to=request.form['To']
+			url_root=request.url_root
 		)
+	elif request.form['CallStatus'] not in ['queued', 'initiated', 'ringing']:
+		# answered, or failed and not worth retrying
+		Scheduler.finish(request.form['To'], inbound_sid)
 
 	return ('', 204)
 
@@ -202,26 +403,29 @@ def ping_outbound():
 def ping_inbound():
 	'''
 	Configured status endpoint for inbound calls.
-	Log data at inbound call completion, and end
-	any active outbound calls.
+	Record inbound call status. Log data at inbound call completion,
+	and queue hangup of every active outbound call, cost capture and archival
+	of the call record, once per call however often Twilio delivers it.
 	'''
-	if request.form['CallStatus'] in ['completed', 'canceled', 'failed']:
+	inbound_sid = request.form['CallSid']
+	if not CallState.record_callback(inbound_sid, request.form['CallStatus'], request.form.get('SequenceNumber')):
+		Metrics.increment('redialer_duplicate_callbacks_total', route='ping_inbound')
+		return ('', 204)
 
-		inbound_call = TRC.calls.get(request.form['CallSid'])
+	if request.form['CallStatus'] in ['completed', 'canceled', 'failed']:
 
 		call_data = {
 			'duration': request.form['Duration'],
 			'ended_at': datetime.datetime.utcnow().isoformat(),
 		}
 
-		CallState.add_cost(inbound_call.sid, inbound_call.price)
-		CallState.set_data(inbound_call.sid, **call_data)
-
-		outbound_sid = CallState.get_last_attempt(inbound_call.sid)
-		if outbound_sid:
-			outbound_call = TRC.calls.get(outbound_sid)
-			if outbound_call.status in ['queued', 'ringing', 'in-progress']:
-				outbound_call.hangup()
+		context = CallState.get_context(inbound_sid=inbound_sid)
+		with CallState.batch() as state:
+			state.set_data(inbound_sid, **call_data)
+			Events.append('ended', inbound_sid, client=state.cache, duration=call_data['duration'])
+		enqueue_job('finish_call', inbound_sid=inbound_sid)
+		for to in get_destinations(context['data']):
+			Scheduler.finish(to, inbound_sid)
 
 	return ('', 204)
 
@@ -232,9 +436,37 @@ def wait_for_outbound():
 	when it is parked in the conference
 	while waiting for the outbound call.
 	'''
+	return Twiml.get(('wait_for_outbound',), render_wait_for_outbound)
+
+def render_wait_for_outbound():
+	'''
+	Render the hold announcement
+	'''
 	response = twilio.twiml.Response()
 	response.say("Please hold and I will keep trying if the line is busy.", voice=TWILIO_VOICE)
 	return str(response)
 
+@app.route("/metrics", methods=['GET'])
+def export_metrics():
+	'''
+	Export latency histograms and counters aggregated across all processes
+	in the Prometheus text format
+	'''
+	lines = [Metrics.render(), '# TYPE redialer_outbound_rate_limit_total counter']
+	for result, count in sorted(OutboundRate.get_counters().items()):
+		lines.append('redialer_outbound_rate_limit_total{{result="{0}"}} {1}'.format(result, count))
+
+	# connection pools are per process, so these only cover the one answering
+	pid = os.getpid()
+	lines.append('# TYPE redialer_redis_pool gauge')
+	for i, stats in enumerate(redisclient.get_pool_stats()):
+		for name, value in sorted(stats.items()):
+			lines.append('redialer_redis_pool{{pid="{0}",pool="{1}",stat="{2}"}} {3}'.format(pid, i, name, value))
+	if TwilioHttp is not None:
+		lines.append('# TYPE redialer_twilio_http_pool gauge')
+		for name, value in sorted(TwilioHttp.get_stats().items()):
+			lines.append('redialer_twilio_http_pool{{pid="{0}",stat="{1}"}} {2}'.format(pid, name, value))
+	return ('\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
 if __name__ == "__main__":
 	app.run()
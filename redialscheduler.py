@@ -0,0 +1,156 @@
+import json
+import random
+import time
+import redisclient
+from callstatemanager import CallStateManager
+
+class RedialScheduler(object):
+	'''
+	Spread outbound attempts to each destination number over time. Callers
+	wait for a destination in the order they first asked for it, each redial
+	waits out a jittered exponential backoff, and only a limited number of
+	attempts per destination are in flight at once.
+	'''
+
+	KEY_IN_FLIGHT = 'dest:{0}:in_flight'
+	KEY_WAITING = 'dest:{0}:waiting'
+	KEY_READY_AT = 'dest:{0}:ready_at'
+	KEY_ENTRIES = 'dest:{0}:entries'
+	KEY_DESTINATIONS = 'dest:waiting'
+
+	# Claim an attempt slot for the first waiting caller whose backoff has
+	# elapsed, dropping callers who've hung up along the way (unless the
+	# status key template is '', as on a cluster, where callers' status keys
+	# are in other slots). Waiting callers without a ready time already have
+	# an attempt in flight. Return the claimed SID ('' for none), its entry
+	# and the number of callers still waiting.
+	# KEYS: in flight, waiting, ready at, entries
+	# ARGV: now, in flight cap, in flight expiry, status key template,
+	# inbound SID (only claim for this caller; '' for any caller)
+	SCRIPT_CLAIM = '''
+		local now = tonumber(ARGV[1])
+		redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+		if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+			return {'', '{}', redis.call('ZCARD', KEYS[2])}
+		end
+		local claimed = false
+		for _, sid in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+			if ARGV[4] ~= '' and redis.call('GET', (string.gsub(ARGV[4], '{0}', sid))) ~= 'in-progress' then
+				redis.call('ZREM', KEYS[1], sid)
+				redis.call('ZREM', KEYS[2], sid)
+				redis.call('HDEL', KEYS[3], sid)
+				redis.call('HDEL', KEYS[4], sid)
+			else
+				local ready_at = redis.call('HGET', KEYS[3], sid)
+				if ready_at and tonumber(ready_at) <= now then
+					if ARGV[5] == '' or ARGV[5] == sid then
+						claimed = sid
+					end
+					break
+				end
+			end
+		end
+		local waiting = redis.call('ZCARD', KEYS[2])
+		if not claimed then
+			return {'', '{}', waiting}
+		end
+		redis.call('HDEL', KEYS[3], claimed)
+		redis.call('ZADD', KEYS[1], now, claimed)
+		return {claimed, redis.call('HGET', KEYS[4], claimed) or '{}', waiting}
+	'''
+
+	def __init__(self, conn_args={}, max_in_flight=3, backoff_base=5, backoff_max=120, backoff_jitter=0.5, in_flight_expiry=660,
+			hash_tags=False, status_key=CallStateManager.KEY_STATUS):
+		self.conn_args = conn_args
+		self.max_in_flight = max_in_flight
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+		self.backoff_jitter = backoff_jitter
+		# an attempt can ring for up to Twilio's 600 second timeout
+		self.in_flight_expiry = in_flight_expiry
+		# with hash tags a destination's keys share a cluster slot, e.g.
+		# dest:{+12025550100}:waiting. On a cluster the claim script can't
+		# read callers' status keys, so callers who've hung up are dropped by
+		# the worker when it finds their call over instead.
+		self.cluster = redisclient.is_cluster(conn_args)
+		self.hash_tags = hash_tags or self.cluster
+		self.status_key = '' if self.cluster else status_key
+
+		self.cache = redisclient.connect(self.conn_args)
+		self.claim_script = self.cache.register_script(self.__class__.SCRIPT_CLAIM)
+
+	def get_keys(self, destination):
+		'''
+		Return the in flight, waiting, ready at and entries keys for a destination
+		'''
+		cls = self.__class__
+		if self.hash_tags:
+			destination = '{' + destination + '}'
+		return [key.format(destination) for key in (cls.KEY_IN_FLIGHT, cls.KEY_WAITING, cls.KEY_READY_AT, cls.KEY_ENTRIES)]
+
+	def get_backoff(self, attempts):
+		'''
+		Return seconds to wait before redialing after a number of attempts
+		'''
+		delay = min(self.backoff_max, self.backoff_base * 2 ** max(attempts - 1, 0))
+		return delay * (1 - self.backoff_jitter * random.random())
+
+	def schedule(self, destination, inbound_sid, delay=0, **entry):
+		'''
+		Queue a caller to be dialed through to a destination after a delay
+		(in seconds), keeping their place in line if they're already waiting.
+		Entry fields are returned by claim for placing the call.
+		'''
+		now = time.time()
+		in_flight_key, waiting_key, ready_at_key, entries_key = self.get_keys(destination)
+		pipe = self.cache.pipeline(transaction=not self.cluster)
+		pipe.zrem(in_flight_key, inbound_sid)
+		pipe.zadd(waiting_key, {inbound_sid: now}, nx=True)
+		pipe.hset(ready_at_key, inbound_sid, now + delay)
+		pipe.hset(entries_key, inbound_sid, json.dumps(entry))
+		for key in self.get_keys(destination):
+			pipe.expire(key, self.in_flight_expiry * 2)
+		pipe.sadd(self.__class__.KEY_DESTINATIONS, destination)
+		pipe.execute()
+
+	def claim(self, destination, inbound_sid=None):
+		'''
+		Take an attempt slot for the next caller waiting on a destination, or
+		only for the given caller if they're next. Return the caller's inbound
+		SID and entry fields, or None if nobody can be dialed now.
+		'''
+		claimed, entry, waiting = self.claim_script(keys=self.get_keys(destination), args=[
+			time.time(), self.max_in_flight, self.in_flight_expiry, self.status_key or '', inbound_sid or ''
+		])
+		if not waiting:
+			self.remove_destination(destination)
+		if not claimed:
+			return None
+		return claimed, json.loads(entry)
+
+	def remove_destination(self, destination):
+		'''
+		Drop a destination from those with callers waiting, unless a caller
+		was scheduled for it meanwhile (schedule adds them before the set)
+		'''
+		self.cache.srem(self.__class__.KEY_DESTINATIONS, destination)
+		if self.cache.zcard(self.get_keys(destination)[1]):
+			self.cache.sadd(self.__class__.KEY_DESTINATIONS, destination)
+
+	def finish(self, destination, inbound_sid):
+		'''
+		Stop dialing a destination for a caller, e.g. once the call connects
+		'''
+		in_flight_key, waiting_key, ready_at_key, entries_key = self.get_keys(destination)
+		pipe = self.cache.pipeline(transaction=not self.cluster)
+		pipe.zrem(in_flight_key, inbound_sid)
+		pipe.zrem(waiting_key, inbound_sid)
+		pipe.hdel(ready_at_key, inbound_sid)
+		pipe.hdel(entries_key, inbound_sid)
+		pipe.execute()
+
+	def get_destinations(self):
+		'''
+		Return destinations with callers waiting to be dialed
+		'''
+		return self.cache.smembers(self.__class__.KEY_DESTINATIONS)
@@ -0,0 +1,107 @@
+import collections
+import threading
+import time
+import redis
+
+# One connection pool per process for each set of connection arguments,
+# shared by every client (call state, jobs, scheduler, metrics, ...) instead
+# of a pool per client. redis-py pools notice when they're used in a forked
+# child and start over with new connections, so clients created before
+# Gunicorn forks never share sockets with the parent.
+pools = {}
+pools_lock = threading.Lock()
+
+class CountingConnectionPool(redis.BlockingConnectionPool):
+	'''
+	Pool that waits for a free connection once max_connections are in use,
+	and counts connections made, checkouts and time spent waiting
+	'''
+	def __init__(self, *args, **kwargs):
+		self.stats_lock = threading.Lock()
+		self.stats = collections.Counter()
+		self.checked_out = set()
+		super(CountingConnectionPool, self).__init__(*args, **kwargs)
+
+	def reset(self):
+		with self.stats_lock:
+			self.stats = collections.Counter()
+			self.checked_out = set()
+		super(CountingConnectionPool, self).reset()
+
+	def make_connection(self):
+		with self.stats_lock:
+			self.stats['created'] += 1
+		return super(CountingConnectionPool, self).make_connection()
+
+	def get_connection(self, *args, **kwargs):
+		start = time.time()
+		connection = super(CountingConnectionPool, self).get_connection(*args, **kwargs)
+		with self.stats_lock:
+			self.stats['checkouts'] += 1
+			self.checked_out.add(id(connection))
+			self.stats['wait_seconds'] += time.time() - start
+		return connection
+
+	def release(self, connection):
+		with self.stats_lock:
+			self.checked_out.discard(id(connection))
+		super(CountingConnectionPool, self).release(connection)
+
+def is_cluster(conn_args):
+	'''
+	Whether connection arguments are for a Redis Cluster
+	'''
+	return bool(conn_args.get('cluster'))
+
+def connect(conn_args={}):
+	'''
+	Create a Redis client from connection arguments: a cluster client if they
+	include 'cluster': True, otherwise a single-node client on the process's
+	shared pool. 'max_connections' caps the pool (default 50) and
+	'pool_timeout' is how long to wait for a free connection (default 5s).
+	'''
+	conn_args = dict(conn_args)
+	if conn_args.pop('cluster', False):
+		# redis-py-cluster 2.x, which runs on redis-py 3.x; it pools per node
+		from rediscluster import RedisCluster
+		conn_args.pop('db', None)
+		conn_args.pop('pool_timeout', None)
+		return RedisCluster(**conn_args)
+	return redis.StrictRedis(connection_pool=get_pool(conn_args))
+
+def get_pool(conn_args):
+	'''
+	Return the shared pool for connection arguments, creating it if needed
+	'''
+	key = repr(sorted(conn_args.items()))
+	with pools_lock:
+		if key not in pools:
+			pool_args = dict(conn_args)
+			pool_args.setdefault('max_connections', 50)
+			pool_args['timeout'] = pool_args.pop('pool_timeout', 5)
+			if pool_args.pop('ssl', False):
+				pool_args['connection_class'] = redis.SSLConnection
+			if 'unix_socket_path' in pool_args:
+				pool_args['connection_class'] = redis.UnixDomainSocketConnection
+				pool_args['path'] = pool_args.pop('unix_socket_path')
+				pool_args.pop('host', None)
+				pool_args.pop('port', None)
+			pools[key] = CountingConnectionPool(**pool_args)
+		return pools[key]
+
+def get_pool_stats():
+	'''
+	Return this process's counts for each shared pool: connections created,
+	checkouts, connections in use and seconds spent waiting for one
+	'''
+	with pools_lock:
+		current = list(pools.values())
+	stats = []
+	for pool in current:
+		with pool.stats_lock:
+			counts = dict(pool.stats, in_use=len(pool.checked_out))
+		for name in ('created', 'checkouts', 'wait_seconds'):
+			counts.setdefault(name, 0)
+		counts['max_connections'] = pool.max_connections
+		stats.append(counts)
+	return stats
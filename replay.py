@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+import Queue
+
+# Play back webhooks recorded with WEBHOOK_TRACE_FILE against a running
+# instance, keeping their original spacing (optionally sped up) so a real
+# call-in day's load can be reproduced locally, e.g. with TWILIO_STUB = True.
+
+CALL_SID_PATTERN = re.compile(r'^CA[0-9a-f]{32}$')
+
+def read_trace(path):
+	'''
+	Read recorded webhooks, ordered by arrival time
+	'''
+	with open(path, 'r') as trace_file:
+		events = [json.loads(line) for line in trace_file if line.strip()]
+	return sorted(events, key=lambda event: event['time'])
+
+def rewrite_sids(form, run_id):
+	'''
+	Replace every call SID in a form with one unique to this run. The same
+	recorded SID always maps to the same new SID, so calls stay linked.
+	'''
+	rewritten = {}
+	for name, value in form.items():
+		if CALL_SID_PATTERN.match(value):
+			value = 'CA' + hashlib.md5((run_id + value).encode('utf-8')).hexdigest()
+		rewritten[name] = value
+	return rewritten
+
+def send(base_url, event, run_id):
+	'''
+	POST a recorded webhook. Return the HTTP status and seconds taken.
+	'''
+	form = rewrite_sids(event['form'], run_id)
+	data = urllib.urlencode(dict((k, v.encode('utf-8')) for k, v in form.items()))
+	start = time.time()
+	try:
+		response = urllib2.urlopen(base_url.rstrip('/') + event['path'], data)
+		status = response.getcode()
+		response.read()
+	except urllib2.HTTPError as e:
+		status = e.code
+	except urllib2.URLError as e:
+		status = None
+	return status, time.time() - start
+
+def percentile(values, fraction):
+	ordered = sorted(values)
+	return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Replay recorded Twilio webhooks against a running instance.')
+	parser.add_argument('trace', help='trace file recorded with WEBHOOK_TRACE_FILE')
+	parser.add_argument('--url', default='http://127.0.0.1:5000', help='base URL of the instance (default: http://127.0.0.1:5000)')
+	parser.add_argument('--speed', type=float, default=1.0, help='playback speed multiplier, e.g. 10 for 10x real time')
+	parser.add_argument('--threads', type=int, default=32, help='maximum concurrent requests')
+	args = parser.parse_args()
+
+	events = read_trace(args.trace)
+	if not events:
+		sys.exit('no webhooks in {0}'.format(args.trace))
+
+	run_id = uuid.uuid4().hex
+	pending = Queue.Queue(maxsize=args.threads * 4)
+	lock = threading.Lock()
+	results = []
+
+	def work():
+		while True:
+			item = pending.get()
+			if item is None:
+				return
+			due, event = item
+			lag = max(0, time.time() - due)
+			status, elapsed = send(args.url, event, run_id)
+			with lock:
+				results.append((event['path'], status, elapsed, lag))
+
+	threads = [threading.Thread(target=work) for i in range(args.threads)]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+
+	first = events[0]['time']
+	start = time.time()
+	for event in events:
+		due = start + (event['time'] - first) / args.speed
+		wait = due - time.time()
+		if wait > 0:
+			time.sleep(wait)
+		pending.put((due, event))
+	for thread in threads:
+		pending.put(None)
+	for thread in threads:
+		thread.join()
+	elapsed = time.time() - start
+
+	by_path = {}
+	for path, status, seconds, lag in results:
+		by_path.setdefault(path, []).append(seconds)
+	errors = sum(1 for path, status, seconds, lag in results if status is None or status >= 400)
+
+	print('{0:<20} {1:>8} {2:>10} {3:>10}'.format('path', 'count', 'p50 ms', 'p99 ms'))
+	for path, values in sorted(by_path.items()):
+		print('{0:<20} {1:>8} {2:>10.2f} {3:>10.2f}'.format(path, len(values), 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.99)))
+	print('')
+	print('replayed {0} webhooks ({1} errors) in {2:.2f}s at {3}x, {4:.1f} requests/s'.format(len(results), errors, elapsed, args.speed, len(results) / elapsed))
+	print('max lag behind schedule: {0:.3f}s'.format(max(lag for path, status, seconds, lag in results)))
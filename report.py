@@ -0,0 +1,160 @@
+import argparse
+import collections
+import csv
+import datetime
+import glob
+import gzip
+import json
+import os
+import sys
+from callstatemanager import CallStateManager
+
+# Cost and attempt reports over call records, read from Redis (live and
+# recently finished calls) and/or the worker's call archive. Records are
+# streamed; only per-destination and per-hour totals are kept in memory.
+
+CALL_FIELDS = ['sid', 'to', 'received_at', 'started_at', 'connected_at', 'ended_at', 'attempts', 'busy_attempts', 'cost_cents', 'connected', 'seconds_to_connect']
+DESTINATION_FIELDS = ['to', 'calls', 'connected', 'mean_attempts_to_connect', 'mean_seconds_to_connect', 'cost_cents']
+HOUR_FIELDS = ['hour', 'attempts', 'busy', 'busy_rate']
+
+def parse_time(value):
+	'''
+	Parse a timestamp stored with datetime.isoformat()
+	'''
+	if not value:
+		return None
+	for time_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+		try:
+			return datetime.datetime.strptime(value, time_format)
+		except ValueError:
+			pass
+	return None
+
+def iter_archive_records(directory):
+	'''
+	Stream records from every archive file in a directory
+	'''
+	for path in sorted(glob.glob(os.path.join(directory, 'calls-*.jsonl.gz'))):
+		with gzip.open(path, 'rb') as archive_file:
+			for line in archive_file:
+				yield json.loads(line)
+
+def summarize_call(record):
+	'''
+	Reduce a call record to a report row
+	'''
+	started_at = parse_time(record.get('started_at'))
+	connected_at = parse_time(record.get('connected_at'))
+	seconds_to_connect = None
+	if started_at and connected_at:
+		seconds_to_connect = (connected_at - started_at).total_seconds()
+	return {
+		'sid': record['sid'],
+		'to': record.get('to'),
+		'received_at': record.get('received_at'),
+		'started_at': record.get('started_at'),
+		'connected_at': record.get('connected_at'),
+		'ended_at': record.get('ended_at'),
+		'attempts': int(record.get('attempts', 0)),
+		'busy_attempts': sum(1 for status in record.get('attempt_statuses', []) if status == 'busy'),
+		'cost_cents': int(record.get('cost', 0)),
+		'connected': connected_at is not None,
+		'seconds_to_connect': seconds_to_connect,
+	}
+
+def iter_destination_rows(calls):
+	'''
+	Aggregate call rows by destination number
+	'''
+	totals = collections.defaultdict(lambda: {'calls': 0, 'connected': 0, 'attempts_to_connect': 0, 'seconds_to_connect': 0.0, 'timed': 0, 'cost_cents': 0})
+	for call in calls:
+		if not call['to']:
+			# e.g. a cost reported after the call was archived
+			continue
+		total = totals[call['to']]
+		total['calls'] += 1
+		total['cost_cents'] += call['cost_cents']
+		if call['connected']:
+			total['connected'] += 1
+			total['attempts_to_connect'] += call['attempts']
+			if call['seconds_to_connect'] is not None:
+				total['seconds_to_connect'] += call['seconds_to_connect']
+				total['timed'] += 1
+	for to, total in sorted(totals.items()):
+		yield {
+			'to': to,
+			'calls': total['calls'],
+			'connected': total['connected'],
+			'mean_attempts_to_connect': float(total['attempts_to_connect']) / total['connected'] if total['connected'] else None,
+			'mean_seconds_to_connect': total['seconds_to_connect'] / total['timed'] if total['timed'] else None,
+			'cost_cents': total['cost_cents'],
+		}
+
+def iter_hour_rows(records):
+	'''
+	Aggregate outbound attempt outcomes by the hour (UTC) each call started
+	'''
+	attempts = collections.Counter()
+	busy = collections.Counter()
+	for record in records:
+		started_at = parse_time(record.get('started_at') or record.get('received_at'))
+		if started_at is None:
+			continue
+		statuses = record.get('attempt_statuses', [])
+		attempts[started_at.hour] += len(statuses)
+		busy[started_at.hour] += sum(1 for status in statuses if status == 'busy')
+	for hour in range(24):
+		yield {
+			'hour': hour,
+			'attempts': attempts[hour],
+			'busy': busy[hour],
+			'busy_rate': float(busy[hour]) / attempts[hour] if attempts[hour] else None,
+		}
+
+def write_rows(rows, fields, output, output_format):
+	'''
+	Write rows to a file one at a time as CSV or JSON lines
+	'''
+	if output_format == 'csv':
+		writer = csv.DictWriter(output, fieldnames=fields)
+		writer.writeheader()
+		for row in rows:
+			writer.writerow(row)
+	else:
+		for row in rows:
+			output.write(json.dumps(row, sort_keys=True) + '\n')
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Report call costs, attempts until connect and busy rates.')
+	parser.add_argument('report', choices=['calls', 'destinations', 'hours'], help='one row per call, per destination number or per hour of day')
+	parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='output format (default: csv)')
+	parser.add_argument('--output', default='-', help='path to write the report to (default: stdout)')
+	parser.add_argument('--archive-dir', help='also read finished calls from this archive directory')
+	parser.add_argument('--no-redis', action='store_true', help="don't read calls from Redis")
+	parser.add_argument('--batch-size', type=int, default=500, help='keys to read from Redis per pipelined batch')
+	parser.add_argument('--pause', type=float, default=0.01, help='seconds to pause between Redis batches')
+	args = parser.parse_args()
+
+	sources = []
+	if not args.no_redis:
+		import config
+		call_state = CallStateManager(conn_args=config.REDIS_CLIENT_KWARGS, ttl=config.REDIS_TTL, hash_tags=getattr(config, 'REDIS_HASH_TAGS', False))
+		sources.append(call_state.iter_call_records(batch_size=args.batch_size, pause=args.pause))
+	if args.archive_dir:
+		sources.append(iter_archive_records(args.archive_dir))
+
+	records = (record for source in sources for record in source)
+
+	if args.report == 'calls':
+		rows, fields = (summarize_call(record) for record in records), CALL_FIELDS
+	elif args.report == 'destinations':
+		rows, fields = iter_destination_rows(summarize_call(record) for record in records), DESTINATION_FIELDS
+	else:
+		rows, fields = iter_hour_rows(records), HOUR_FIELDS
+
+	output = sys.stdout if args.output == '-' else open(args.output, 'w')
+	try:
+		write_rows(rows, fields, output, args.format)
+	finally:
+		if output is not sys.stdout:
+			output.close()
@@ -0,0 +1,25 @@
+# Serve the webhooks with cooperative green threads (gevent) instead of one
+# OS thread per request. Redis, Twilio and pub/sub sockets yield while they
+# wait, so one process keeps many webhooks in flight during a surge. The
+# routes are redialer.py's, so responses are identical to the Flask app's.
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Serve the webhooks with gevent.')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('--port', type=int, default=5000, help='port to listen on (default: 5000)')
+	parser.add_argument('--connections', type=int, default=1000,
+		help="maximum webhooks handled at once; size REDIS_CLIENT_KWARGS['max_connections'] to match")
+	args = parser.parse_args()
+
+	# import after patching, so the app's clients and threads are cooperative
+	import redialer
+
+	server = WSGIServer((args.host, args.port), redialer.app, spawn=Pool(args.connections))
+	print('Serving on http://{0}:{1}/ with up to {2} concurrent webhooks'.format(args.host, args.port, args.connections))
+	server.serve_forever()
@@ -0,0 +1,90 @@
+import pytest
+from callstatemanager import CallStateManager
+
+class StubCall(object):
+	def __init__(self, sid, to, status='queued'):
+		self.sid = sid
+		self.to = to
+		self.status = status
+
+@pytest.fixture(params=[False, True], ids=['plain', 'hash_tags'])
+def state(server, request):
+	return CallStateManager(hash_tags=request.param)
+
+def start_call(state, inbound_sid='CA_IN', outbound_sids=('CA_OUT',)):
+	with state.batch() as batch:
+		batch.set_data(inbound_sid, **{'from': '+15550001111'})
+		batch.set_status(inbound_sid, 'in-progress')
+	for outbound_sid in outbound_sids:
+		state.log_new_attempt(inbound_sid, StubCall(outbound_sid, '+12025550100'))
+
+def test_archive_keeps_attempt_keys(state):
+	start_call(state)
+	state.record_callback('CA_OUT', 'ringing')
+
+	record = state.archive_call('CA_IN')
+
+	assert record['attempt_sids'] == ['CA_OUT']
+	assert record['attempt_statuses'] == ['ringing']
+	assert not state.has_data('CA_IN')
+	# a late callback for the attempt still finds its caller and status
+	assert state.get_origin('CA_OUT') == 'CA_IN'
+	assert state.is_active('CA_OUT')
+	assert state.cache.ttl(state.get_origin_key('CA_OUT')) > 0
+
+def test_active_attempts(state):
+	start_call(state, outbound_sids=('CA_OUT1', 'CA_OUT2'))
+	state.record_callback('CA_OUT1', 'busy')
+
+	assert state.get_active_attempts('CA_IN') == ['CA_OUT2']
+
+def test_get_context(state):
+	start_call(state, outbound_sids=('CA_OUT1', 'CA_OUT2'))
+	state.record_callback('CA_OUT2', 'ringing')
+
+	context = state.get_context(outbound_sid='CA_OUT2')
+
+	assert context['inbound_sid'] == 'CA_IN'
+	assert context['status'] == 'in-progress'
+	assert context['last_attempt'] == 'CA_OUT2'
+	assert context['last_attempt_status'] == 'ringing'
+	assert context['data']['to'] == '+12025550100'
+
+def test_set_status_only_moves_forward(state):
+	state.set_status('CA_OUT', 'completed')
+	assert state.set_status('CA_OUT', 'ringing') == 'completed'
+	assert state.get_status('CA_OUT') == 'completed'
+
+def test_record_callback_ignores_redeliveries(state):
+	start_call(state)
+
+	assert state.record_callback('CA_OUT', 'ringing', '1')
+	assert not state.record_callback('CA_OUT', 'ringing', '1')
+	assert state.record_callback('CA_OUT', 'busy', '2')
+	assert not state.record_callback('CA_OUT', 'busy', '2')
+
+def test_record_callback_ignores_late_callbacks(state):
+	start_call(state)
+
+	assert state.record_callback('CA_OUT', 'completed', '3')
+	assert not state.record_callback('CA_OUT', 'ringing', '1')
+	assert state.get_status('CA_OUT') == 'completed'
+
+def test_record_callback_after_archival(state):
+	start_call(state)
+	assert state.record_callback('CA_IN', 'completed', '1')
+	state.archive_call('CA_IN')
+
+	# redelivered after the worker archived the call: still not acted on
+	assert not state.record_callback('CA_IN', 'completed', '1')
+	assert not state.has_data('CA_IN')
+	assert state.archive_call('CA_IN') is None
+
+def test_set_status_in_cluster_batch(state):
+	state.cluster = True
+	state.cache.script_flush()
+
+	with state.batch() as batch:
+		batch.set_status('CA_OUT', 'ringing')
+
+	assert state.get_status('CA_OUT') == 'ringing'
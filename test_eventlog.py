@@ -0,0 +1,50 @@
+import pytest
+from eventlog import EventLog
+
+@pytest.fixture
+def events(server):
+	events = EventLog(min_idle_time=0)
+	events.create_group()
+	return events
+
+def test_fold_into_summaries(events):
+	events.append('received', 'CA_IN', **{'from': '+15550001111'})
+	events.append('member_selected', 'CA_IN', to='+12025550100')
+	events.append('attempt', 'CA_IN', to='+12025550100', call_sid='CA_OUT1')
+	events.append('busy', 'CA_IN', to='+12025550100', call_sid='CA_OUT1')
+	events.append('cost', 'CA_IN', cost_cents=3, to='+12025550100')
+
+	assert events.consume('consumer-1', block=0.01) == 5
+
+	summary = events.get_call_summary('CA_IN')
+	assert summary['from'] == '+15550001111'
+	assert summary['to'] == '+12025550100'
+	assert (summary['attempts'], summary['busy'], summary['cost_cents']) == ('1', '1', '3')
+	assert events.get_destination_summaries() == {'+12025550100': {'calls': '1', 'attempts': '1', 'busy': '1', 'cost_cents': '3'}}
+
+def test_append_without_inbound_sid(events):
+	events.append('busy', None, to='+12025550100')
+
+	assert events.cache.xlen(events.get_stream_key()) == 0
+
+def test_claim_stale_events(events):
+	events.append('attempt', 'CA_IN', to='+12025550100')
+	stream_key = events.get_stream_key()
+	# delivered to a consumer that stopped before folding them
+	events.cache.xreadgroup(EventLog.GROUP, 'stopped', {stream_key: '>'})
+
+	assert events.consume('consumer-1', block=0.01) == 1
+	assert events.cache.xpending(stream_key, EventLog.GROUP)['pending'] == 0
+	assert events.get_call_summary('CA_IN')['attempts'] == '1'
+
+def test_trimmed_stale_events_are_acknowledged(events, monkeypatch):
+	stream_key = events.get_stream_key()
+	trimmed_id = events.cache.xadd(stream_key, {'event': 'attempt', 'sid': 'CA_OLD'})
+	events.cache.xreadgroup(EventLog.GROUP, 'stopped', {stream_key: '>'})
+	events.append('attempt', 'CA_IN', to='+12025550100')
+	# Redis before 7 returns events trimmed from the stream without fields
+	monkeypatch.setattr(events.cache, 'xclaim', lambda *args: [(trimmed_id, None)])
+
+	assert events.consume('consumer-1', block=0.01) == 1
+	assert events.cache.xpending(stream_key, EventLog.GROUP)['pending'] == 0
+	assert events.get_call_summary('CA_IN')['attempts'] == '1'
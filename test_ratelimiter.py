@@ -0,0 +1,41 @@
+import time
+import pytest
+from ratelimiter import RateLimiter
+
+@pytest.fixture
+def limiter(server):
+	return RateLimiter(rate=1, burst=2, max_wait=0.5)
+
+def test_reserve_within_burst(limiter):
+	assert limiter.reserve() == 0
+	assert limiter.reserve() == 0
+	assert limiter.get_counters() == {'admitted': 2, 'delayed': 0, 'rejected': 0}
+
+def test_reserve_in_debt(limiter):
+	limiter.reserve()
+	limiter.reserve()
+
+	assert 0.9 < limiter.reserve(max_wait=10) <= 1
+	assert 1.9 < limiter.reserve(max_wait=10) <= 2
+	assert limiter.get_counters() == {'admitted': 4, 'delayed': 2, 'rejected': 0}
+
+def test_rejection_returns_wait(limiter):
+	limiter.reserve()
+	limiter.reserve()
+
+	wait = limiter.reserve()
+	assert -1 <= wait < -0.9
+	# nothing was taken, so the next request is told the same
+	assert -1 <= limiter.reserve(max_wait=0) < -0.9
+	assert not limiter.acquire()
+	assert limiter.get_counters() == {'admitted': 2, 'delayed': 0, 'rejected': 3}
+
+def test_bucket_outlives_debt(limiter):
+	limiter.rate, limiter.burst = 10, 1
+	for i in range(40):
+		limiter.reserve(max_wait=10)
+
+	# past the time a bucket without debt would take to refill (and expire)
+	time.sleep(2.1)
+
+	assert limiter.reserve(max_wait=10) > 1
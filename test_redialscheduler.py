@@ -0,0 +1,64 @@
+import pytest
+from callstatemanager import CallStateManager
+from redialscheduler import RedialScheduler
+
+@pytest.fixture(params=[False, True], ids=['plain', 'hash_tags'])
+def state(server, request):
+	return CallStateManager(hash_tags=request.param)
+
+@pytest.fixture
+def scheduler(state):
+	return RedialScheduler(max_in_flight=2, hash_tags=state.hash_tags, status_key=state.get_status_key('{0}'))
+
+def wait_for(state, scheduler, *inbound_sids, **kwargs):
+	for inbound_sid in inbound_sids:
+		state.set_status(inbound_sid, 'in-progress')
+		scheduler.schedule('+12025550100', inbound_sid, kwargs.get('delay', 0), from_='+15550001111')
+
+def test_claim_in_order(state, scheduler):
+	wait_for(state, scheduler, 'CA_1', 'CA_2')
+
+	assert scheduler.claim('+12025550100') == ('CA_1', {'from_': '+15550001111'})
+	assert scheduler.claim('+12025550100')[0] == 'CA_2'
+
+def test_claim_keeps_place_in_line(state, scheduler):
+	wait_for(state, scheduler, 'CA_1', 'CA_2')
+	# a redial after a busy signal keeps the caller's original place
+	scheduler.schedule('+12025550100', 'CA_1', 0)
+
+	assert scheduler.claim('+12025550100')[0] == 'CA_1'
+
+def test_claim_skips_callers_backing_off(state, scheduler):
+	wait_for(state, scheduler, 'CA_1', delay=60)
+	wait_for(state, scheduler, 'CA_2')
+
+	assert scheduler.claim('+12025550100', 'CA_1') is None
+	assert scheduler.claim('+12025550100')[0] == 'CA_2'
+	assert scheduler.claim('+12025550100') is None
+
+def test_claim_caps_attempts_in_flight(state, scheduler):
+	wait_for(state, scheduler, 'CA_1', 'CA_2', 'CA_3')
+
+	assert scheduler.claim('+12025550100')[0] == 'CA_1'
+	assert scheduler.claim('+12025550100')[0] == 'CA_2'
+	assert scheduler.claim('+12025550100') is None
+
+	scheduler.finish('+12025550100', 'CA_1')
+	assert scheduler.claim('+12025550100')[0] == 'CA_3'
+
+def test_claim_drops_callers_who_hung_up(state, scheduler):
+	wait_for(state, scheduler, 'CA_1', 'CA_2')
+	state.set_status('CA_1', 'completed')
+
+	assert scheduler.claim('+12025550100')[0] == 'CA_2'
+	in_flight_key, waiting_key, ready_at_key, entries_key = scheduler.get_keys('+12025550100')
+	assert scheduler.cache.zrange(waiting_key, 0, -1) == ['CA_2']
+	assert not scheduler.cache.hexists(entries_key, 'CA_1')
+
+def test_finished_destination_is_dropped(state, scheduler):
+	wait_for(state, scheduler, 'CA_1')
+	scheduler.claim('+12025550100')
+	scheduler.finish('+12025550100', 'CA_1')
+
+	assert scheduler.claim('+12025550100') is None
+	assert scheduler.get_destinations() == set()
@@ -0,0 +1,78 @@
+import datetime
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+class StubCall(object):
+	'''
+	Minimal stand-in for a Twilio call instance
+	'''
+	def __init__(self, sid, to=None, from_=None, status='queued', price=None):
+		self.sid = sid
+		self.to = to
+		self.from_ = from_
+		self.status = status
+		self.price = price
+		self.date_created = datetime.datetime.utcnow().replace(microsecond=0)
+
+	def hangup(self):
+		logger.info('stub hangup %s', self.sid)
+		self.status = 'completed'
+		return self
+
+class StubCalls(object):
+	'''
+	In-memory stand-in for the Twilio calls resource. Calls not created
+	through this instance (e.g. the inbound leg) are reported with the
+	default status and price.
+	'''
+	def __init__(self, default_status='in-progress', default_price=None):
+		self.default_status = default_status
+		self.default_price = default_price
+		self.calls = {}
+		self.sids = ('CA{0:032d}'.format(i) for i in itertools.count(1))
+
+	def create(self, to=None, from_=None, **kwargs):
+		call = StubCall(next(self.sids), to=to, from_=from_)
+		logger.info('stub create %s to %s', call.sid, to)
+		self.calls[call.sid] = call
+		return call
+
+	def hangup(self, sid):
+		return self.get(sid).hangup()
+
+	def get(self, sid):
+		if sid not in self.calls:
+			self.calls[sid] = StubCall(sid, status=self.default_status, price=self.default_price)
+		return self.calls[sid]
+
+	def list(self, status=None, from_=None, page=0, page_size=50, **kwargs):
+		'''
+		Return one page of calls, newest first, optionally filtered by status
+		and caller ID
+		'''
+		calls = [call for call in reversed(list(self.calls.values()))
+			if (status is None or call.status == status) and (from_ is None or call.from_ == from_)]
+		return calls[page * page_size:(page + 1) * page_size]
+
+	def iter(self, **kwargs):
+		'''
+		Yield every call matching the filters, a page at a time
+		'''
+		page = 0
+		while True:
+			calls = self.list(page=page, **kwargs)
+			for call in calls:
+				yield call
+			if len(calls) < kwargs.get('page_size', 50):
+				return
+			page += 1
+
+class StubTwilioRestClient(object):
+	'''
+	Offline replacement for twilio.rest.TwilioRestClient. Accepts and
+	ignores the same constructor arguments.
+	'''
+	def __init__(self, *args, **kwargs):
+		self.calls = StubCalls()
@@ -0,0 +1,107 @@
+import collections
+import os
+import threading
+import httplib2
+from six import binary_type, integer_types, iteritems, string_types
+from six.moves import queue
+from six.moves.urllib.parse import urlencode, urlparse
+from twilio.rest.resources import base
+from twilio.rest.resources.connection import Connection
+
+class HttpPool(object):
+	'''
+	Per-process pool of keep-alive HTTP clients for the Twilio REST client.
+	twilio 5.x opens a new HTTPS connection (and TLS handshake) for every API
+	request; install() routes its requests through these clients instead, so
+	connections to the API are reused. Each client serves one request at a
+	time, so up to size requests run at once and the rest wait for a client.
+	'''
+
+	def __init__(self, size=10, timeout=30):
+		self.size = size
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.stats = collections.Counter()
+		self.pid = None
+		self.reset()
+
+	def reset(self):
+		'''
+		Drop every client, e.g. in a forked child whose clients' sockets
+		belong to the parent
+		'''
+		self.pid = os.getpid()
+		self.clients = queue.LifoQueue()
+		for i in range(self.size):
+			self.clients.put(None)
+		with self.lock:
+			self.stats = collections.Counter()
+
+	def checkout(self):
+		if self.pid != os.getpid():
+			self.reset()
+		http = self.clients.get()
+		if http is None:
+			http = httplib2.Http(timeout=self.timeout, ca_certs=base.get_cert_file(), proxy_info=Connection.proxy_info())
+			with self.lock:
+				self.stats['created'] += 1
+		return http
+
+	def checkin(self, http):
+		if self.pid == os.getpid():
+			self.clients.put(http)
+
+	def request(self, method, url, params=None, data=None, headers=None, cookies=None, files=None,
+			auth=None, timeout=None, allow_redirects=False, proxies=None):
+		'''
+		Send an HTTP request; a drop-in replacement for twilio's make_request
+		'''
+		if data is not None:
+			data = urlencode(dict((k.encode('utf-8'), encode_value(v)) for k, v in iteritems(data)), doseq=True)
+		if params is not None:
+			url = '{0}{1}{2}'.format(url, '&' if urlparse(url).query else '?', urlencode(params, doseq=True))
+
+		http = self.checkout()
+		try:
+			http.follow_redirects = allow_redirects
+			http.credentials.clear()
+			if auth is not None:
+				http.add_credentials(auth[0], auth[1])
+			resp, content = http.request(url, method, headers=headers, body=data)
+		except Exception:
+			# the connection may be in an unknown state; start the next request afresh
+			http = None
+			raise
+		finally:
+			self.checkin(http)
+			with self.lock:
+				self.stats['requests'] += 1
+		return base.Response(resp, content.decode('utf-8'), url)
+
+	def get_stats(self):
+		'''
+		Return counts of requests sent and HTTP clients created in this process
+		'''
+		with self.lock:
+			return {'requests': self.stats['requests'], 'created': self.stats['created'], 'size': self.size}
+
+def encode_value(value):
+	if isinstance(value, (list, tuple, set)):
+		return [encode_atom(atom) for atom in value]
+	return encode_atom(value)
+
+def encode_atom(atom):
+	if isinstance(atom, (integer_types, binary_type)):
+		return atom
+	if isinstance(atom, string_types):
+		return atom.encode('utf-8')
+	raise ValueError('data should be an integer, binary, or string, or sequence')
+
+def install(size=10, timeout=30):
+	'''
+	Send every Twilio REST API request in this process through a shared
+	HttpPool, and return it
+	'''
+	pool = HttpPool(size=size, timeout=timeout)
+	base.make_request = pool.request
+	return pool
@@ -0,0 +1,43 @@
+import collections
+import threading
+
+class TwimlCache(object):
+	'''
+	Bounded, thread-safe LRU cache of rendered TwiML strings, so responses
+	that only depend on roster/ZIP data (e.g. the member menu for a ZIP)
+	are rendered once per worker rather than on every request.
+	'''
+
+	def __init__(self, max_size=1024):
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, render):
+		'''
+		Return the cached TwiML for a key, calling render() to produce and
+		cache it on a miss
+		'''
+		with self.lock:
+			if key in self.entries:
+				twiml = self.entries.pop(key)
+				self.entries[key] = twiml
+				return twiml
+
+		twiml = render()
+
+		with self.lock:
+			self.entries[key] = twiml
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+		return twiml
+
+	def clear(self):
+		'''
+		Drop every cached response, e.g. after a new roster is swapped in
+		'''
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
@@ -1,28 +1,48 @@
 from unidecode import unidecode
 import re
 import csv
+import itertools
 import urllib2
 
-def csv_url_to_dicts(url, ignore_first=0, **csv_parse_args):
+# Map of letters to their telephone dialpad digits
+DIALPAD_MAP = dict(zip(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), list('22233344455566677778889999')))
+
+def open_source(source):
 	'''
-	Retrieve CSV from URL. Parse into an array of dicts,
-	assuming headers are on first line.
+	Open a URL or local file path for line-by-line reading.
 	'''
-	lines = urllib2.urlopen(url).read().rstrip().split("\n")[ignore_first:]
+	if re.match(r'^[a-z]+://', source):
+		return urllib2.urlopen(source)
+	return open(source, 'r')
 
-	line_iter = csv.reader(lines, **csv_parse_args)
-
-	headers = None
+def iter_csv_dicts(source, ignore_first=0, **csv_parse_args):
+	'''
+	Stream CSV from a URL or local file. Yield a dict per row,
+	assuming headers are on first line.
+	'''
+	source_file = open_source(source)
+	try:
+		line_iter = csv.reader(itertools.islice(source_file, ignore_first, None), **csv_parse_args)
 
-	rows = []
+		headers = None
 
-	for line in line_iter:
-		if headers == None:
-			headers = line
-		else:
-			rows.append(dict(zip(headers, line)))
+		for line in line_iter:
+			if not line:
+				# skip blank lines, e.g. trailing newlines
+				continue
+			if headers == None:
+				headers = line
+			else:
+				yield dict(zip(headers, line))
+	finally:
+		source_file.close()
 
-	return rows
+def csv_url_to_dicts(url, ignore_first=0, **csv_parse_args):
+	'''
+	Retrieve CSV from URL. Parse into an array of dicts,
+	assuming headers are on first line.
+	'''
+	return list(iter_csv_dicts(url, ignore_first, **csv_parse_args))
 
 def remove_diacritics(value):
 	'''
@@ -40,5 +60,4 @@ def str_to_dialpad(value):
 	'''
 	Convert a string to its telephone dialpad equivalent
 	'''
-	dial_map = dict(zip(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), list('22233344455566677778889999')))
-	return "".join([dial_map[c] for c in sanitize_for_dialpad(value)])
\ No newline at end of file
+	return "".join([DIALPAD_MAP[c] for c in sanitize_for_dialpad(value)])
\ No newline at end of file
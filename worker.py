@@ -0,0 +1,244 @@
+import argparse
+import calendar
+import os
+import socket
+import threading
+import time
+import congress
+from callarchive import CallArchive
+from redialer import app, TRC, CallState, Jobs, Scheduler, Events, Metrics, place_outbound_call
+
+Archive = CallArchive(directory=app.config.get('CALL_ARCHIVE_DIR', 'archive'))
+
+# Twilio REST API work queued by the webhooks in redialer.py. Each job runs in
+# a request context for the URL root it was queued from so url_for still works.
+
+def place_scheduled_call(inbound_sid, from_, to, rate_reserved=False):
+	'''
+	Place an outbound call claimed from the redial scheduler, but only if
+	originating call is still connected and no other office has answered it.
+	'''
+	if CallState.get_status(inbound_sid) == 'in-progress' and not CallState.get_bridge(inbound_sid):
+		app.logger.info('dialing %s', to)
+		place_outbound_call(inbound_sid=inbound_sid, from_=from_, to=to, rate_reserved=rate_reserved)
+	else:
+		Scheduler.finish(to, inbound_sid)
+
+def capture_cost(inbound_sid, call_sid):
+	'''
+	Look up the price of a finished call and add it to the inbound call's cost.
+	If the inbound call has already been archived, archive the cost on its own.
+	'''
+	if not inbound_sid:
+		app.logger.warning('no inbound call to add the cost of %s to', call_sid)
+		return
+	call = TRC.calls.get(call_sid)
+	cost = CallState.get_cost_cents(call.price)
+	if cost:
+		# outbound legs' costs also count towards their destination's totals
+		Events.append('cost', inbound_sid, cost_cents=cost, to=call.to if call_sid != inbound_sid else None)
+	if CallState.has_data(inbound_sid):
+		CallState.add_cost(inbound_sid, call.price)
+	elif cost:
+		Archive.append({'sid': inbound_sid, 'cost': cost})
+
+def finish_call(inbound_sid):
+	'''
+	Hang up a finished inbound call's outbound attempts that are still active
+	and capture its cost, then move its record from Redis to the archive.
+	'''
+	# before archiving, which drops the list of attempts
+	for outbound_sid in CallState.get_active_attempts(inbound_sid):
+		try:
+			TRC.calls.hangup(outbound_sid)
+		except Exception:
+			app.logger.exception('hanging up %s failed', outbound_sid)
+	capture_cost(inbound_sid, inbound_sid)
+	record = CallState.archive_call(inbound_sid)
+	if record is not None:
+		Archive.append(record)
+
+def hang_up_outbound(outbound_sid):
+	'''
+	End an outbound call that's still active.
+	'''
+	if CallState.is_active(outbound_sid):
+		TRC.calls.hangup(outbound_sid)
+
+def get_call_age(call):
+	'''
+	Return seconds since a Twilio call was created, or None if unknown. The
+	client parses date_created into a naive datetime in UTC.
+	'''
+	if not call.date_created:
+		return None
+	return time.time() - calendar.timegm(call.date_created.utctimetuple())
+
+def reap_orphaned_calls(grace=60, page_size=200):
+	'''
+	Hang up outbound legs still queued or ringing whose inbound caller is gone,
+	e.g. earlier attempts, or ones whose hangup job was lost. Twilio's call
+	list is paged through and each page is checked against Redis in two
+	pipelined round trips. Legs younger than grace seconds are left alone, as
+	their origin may not be recorded yet. Return the number hung up.
+	'''
+	orphans = []
+	for status in ('queued', 'ringing'):
+		page = []
+		# each page of the listing is one API request, timed as it's read
+		started = time.time()
+		for call in TRC.calls.iter(status=status, from_=app.config['TWILIO_DEFAULT_FROM'], page_size=page_size):
+			page.append(call)
+			if len(page) >= page_size:
+				Metrics.observe('redialer_twilio_seconds', time.time() - started, method='iter')
+				orphans.extend(find_orphans(page, grace))
+				page = []
+				started = time.time()
+		Metrics.observe('redialer_twilio_seconds', time.time() - started, method='iter')
+		orphans.extend(find_orphans(page, grace))
+
+	# hang up once listing is done, as that changes which calls match
+	reaped = 0
+	for sid in orphans:
+		try:
+			TRC.calls.hangup(sid)
+			reaped += 1
+		except Exception:
+			app.logger.exception('hanging up orphaned call %s failed', sid)
+	if reaped:
+		app.logger.info('hung up %d orphaned calls', reaped)
+		Metrics.increment('redialer_orphaned_calls_total', reaped)
+	return reaped
+
+def find_orphans(calls, grace):
+	'''
+	Return the SIDs of the calls, older than grace seconds, that are orphaned
+	'''
+	if not calls:
+		return []
+	orphans = set(CallState.get_orphaned_attempts([call.sid for call in calls]))
+	return [call.sid for call in calls if call.sid in orphans and (get_call_age(call) or 0) >= grace]
+
+def reap(interval, burst=False):
+	'''
+	Hang up orphaned outbound legs every interval seconds until stopped, or
+	once if bursting.
+	'''
+	while True:
+		try:
+			reap_orphaned_calls(grace=app.config.get('REAPER_GRACE', 60))
+		except Exception:
+			app.logger.exception('reaping orphaned calls failed')
+		if burst:
+			return
+		time.sleep(interval)
+
+JOBS = {
+	'place_scheduled_call': place_scheduled_call,
+	'capture_cost': capture_cost,
+	'finish_call': finish_call,
+	'hang_up_outbound': hang_up_outbound,
+}
+
+def run_job(job, kwargs):
+	'''
+	Execute a single dequeued job, logging rather than raising any error.
+	'''
+	url_root = kwargs.pop('url_root', None)
+	try:
+		with app.test_request_context(base_url=url_root):
+			JOBS[job](**kwargs)
+	except Exception:
+		app.logger.exception('job %s failed', job)
+
+def work(burst=False, timeout=5):
+	'''
+	Process jobs until stopped, or until the queue is empty if bursting.
+	'''
+	while True:
+		item = Jobs.dequeue(timeout=timeout)
+		if item is None:
+			if burst:
+				return
+			continue
+		run_job(*item)
+
+def dispatch_scheduled_calls():
+	'''
+	Queue a job placing every outbound call the redial scheduler has a free
+	slot for. The worker threads place them, so a call waiting on the rate
+	limit or the Twilio API never holds up redials to other destinations.
+	'''
+	for destination in Scheduler.get_destinations():
+		while True:
+			claimed = Scheduler.claim(destination)
+			if claimed is None:
+				break
+			inbound_sid, entry = claimed
+			Jobs.enqueue('place_scheduled_call', **dict(entry, inbound_sid=inbound_sid, to=destination))
+
+def dispatch(burst=False, interval=1):
+	'''
+	Dispatch scheduled calls until stopped, or once if bursting.
+	'''
+	while True:
+		dispatch_scheduled_calls()
+		if burst:
+			return
+		time.sleep(interval)
+
+def fold_events(consumer, burst=False):
+	'''
+	Fold call lifecycle events into per-call and per-destination summaries
+	until stopped, or until no events are left if bursting.
+	'''
+	Events.create_group()
+	while True:
+		try:
+			folded = Events.consume(consumer, block=1)
+		except Exception:
+			app.logger.exception('folding events failed')
+			folded = 0
+			time.sleep(1)
+		if burst and not folded:
+			return
+
+def download_roster(interval):
+	'''
+	Download the roster and write a new local snapshot every interval seconds.
+	Web workers pick up the new version (see congress.start_refresher).
+	'''
+	while True:
+		try:
+			members = congress.download_members()
+			if congress.get_roster_version(members) != congress.get_roster().version:
+				app.logger.info('roster snapshot %s', congress.write_members_snapshot(members))
+				congress.refresh_roster()
+		except Exception:
+			app.logger.exception('roster download failed')
+		time.sleep(interval)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Run queued Twilio API jobs for the redialer webhooks.')
+	parser.add_argument('--threads', type=int, default=app.config.get('WORKER_THREADS', 4), help='number of worker threads')
+	parser.add_argument('--burst', action='store_true', help='exit once the queue is empty')
+	parser.add_argument('--event-consumers', type=int, default=app.config.get('EVENT_CONSUMERS', 1), help='number of threads folding call events into summaries')
+	args = parser.parse_args()
+
+	threads = [threading.Thread(target=work, kwargs={'burst': args.burst, 'timeout': 1 if args.burst else 5}) for i in range(args.threads)]
+	if app.config.get('MEMBERS_DOWNLOAD_INTERVAL') and not args.burst:
+		threads.append(threading.Thread(target=download_roster, args=(app.config['MEMBERS_DOWNLOAD_INTERVAL'],)))
+	threads.append(threading.Thread(target=dispatch, kwargs={'burst': args.burst, 'interval': app.config.get('REDIAL_DISPATCH_INTERVAL', 1)}))
+	if app.config.get('REAPER_INTERVAL'):
+		threads.append(threading.Thread(target=reap, args=(app.config['REAPER_INTERVAL'],), kwargs={'burst': args.burst}))
+	for i in range(args.event_consumers):
+		# consumer names must be unique across every worker process
+		consumer = '{0}-{1}-{2}'.format(socket.gethostname(), os.getpid(), i)
+		threads.append(threading.Thread(target=fold_events, args=(consumer,), kwargs={'burst': args.burst}))
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		# join with a timeout so the main thread still receives KeyboardInterrupt
+		while thread.is_alive():
+			thread.join(1)